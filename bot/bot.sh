@@ -15,6 +15,9 @@ PTH=$WORK_DIR $PYTHON ./download_extract.py || exit 1
 test -f $WORK_DIR/output.gmt || exit 1
 test -f $WORK_DIR/done.new.txt || exit 1
 
+echo "compiling the gene lookup..."
+$PYTHON -m helper build-lookup || exit 1
+
 echo "assembling output-clean.gmt... (pruned, and normalized gene sets)"
 $PYTHON -m helper clean -i $WORK_DIR/output.gmt -o $WORK_DIR/output-clean.gmt || exit 1
 test -f $WORK_DIR/output-clean.gmt || exit 1
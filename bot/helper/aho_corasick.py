@@ -0,0 +1,59 @@
+import typing as t
+
+class AhoCorasick:
+  ''' An Aho-Corasick automaton over a list of patterns, finds which patterns occur in a text in a
+  single pass over it regardless of the number of patterns.
+  '''
+  def __init__(self, patterns: t.Iterable[str]):
+    import collections
+    self.patterns = list(patterns)
+    # node 0 is the root, edges[node] maps a character to the next node
+    self.edges: list[dict[str, int]] = [{}]
+    # the patterns ending at each node
+    self.outputs: list[list[int]] = [[]]
+    for i, pattern in enumerate(self.patterns):
+      node = 0
+      for c in pattern:
+        next_node = self.edges[node].get(c)
+        if next_node is None:
+          next_node = self.edges[node][c] = len(self.edges)
+          self.edges.append({})
+          self.outputs.append([])
+        node = next_node
+      self.outputs[node].append(i)
+    # fail[node] is the longest proper suffix of node which is also in the trie,
+    #  dict_link[node] the nearest node along the fail links with any outputs
+    self.fail = [0] * len(self.edges)
+    self.dict_link = [0] * len(self.edges)
+    # children of the root fail to the root, the rest are filled in breadth first
+    queue = collections.deque(self.edges[0].values())
+    while queue:
+      node = queue.popleft()
+      for c, child in self.edges[node].items():
+        fail = self.fail[node]
+        while fail and c not in self.edges[fail]:
+          fail = self.fail[fail]
+        self.fail[child] = self.edges[fail].get(c, 0)
+        self.dict_link[child] = self.fail[child] if self.outputs[self.fail[child]] else self.dict_link[self.fail[child]]
+        queue.append(child)
+
+  def find_all(self, text: str) -> t.Iterator[int]:
+    ''' Yield the index of each pattern every time it occurs in `text`
+    '''
+    # empty patterns occur in any text
+    yield from self.outputs[0]
+    edges, fail, outputs, dict_link = self.edges, self.fail, self.outputs, self.dict_link
+    node = 0
+    for c in text:
+      while node and c not in edges[node]:
+        node = fail[node]
+      node = edges[node].get(c, 0)
+      match = node if outputs[node] else dict_link[node]
+      while match:
+        yield from outputs[match]
+        match = dict_link[match]
+
+  def matches(self, text: str) -> set[int]:
+    ''' The indices of the patterns which occur in `text`
+    '''
+    return set(self.find_all(text))
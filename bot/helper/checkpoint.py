@@ -0,0 +1,49 @@
+from pathlib import Path
+
+def content_hash(path: Path | str, blocksize=1<<20):
+  ''' The sha256 of a file's contents
+  '''
+  import hashlib
+  h = hashlib.sha256()
+  with Path(path).open('rb') as fr:
+    while block := fr.read(blocksize):
+      h.update(block)
+  return h.hexdigest()
+
+def load_checkpoint(plpy, source: str, content_hash: str):
+  ''' Get the last saved checkpoint for this source & content, or None if there isn't one
+  '''
+  for row in plpy.cursor(
+    plpy.prepare(
+      '''
+        select byte_offset, n_records, completed
+        from app_private_v2.ingest_checkpoint
+        where source = $1 and content_hash = $2
+      ''',
+      ['varchar', 'varchar'],
+    ),
+    [source, content_hash],
+  ):
+    return row
+  return None
+
+def save_checkpoint(plpy, source: str, content_hash: str, byte_offset: int, n_records: int, completed=False):
+  ''' Record progress for this source & content, this doesn't commit, the caller should commit
+  it alongside the data it describes
+  '''
+  plpy.execute(
+    plpy.prepare(
+      '''
+        insert into app_private_v2.ingest_checkpoint (source, content_hash, byte_offset, n_records, completed)
+        values ($1, $2, $3, $4, $5)
+        on conflict (source, content_hash)
+        do update set
+          byte_offset = excluded.byte_offset,
+          n_records = excluded.n_records,
+          completed = excluded.completed,
+          updated = now()
+      ''',
+      ['varchar', 'varchar', 'bigint', 'bigint', 'boolean'],
+    ),
+    [source, content_hash, byte_offset, n_records, completed],
+  )
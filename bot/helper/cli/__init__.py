@@ -1,3 +1,52 @@
 import click
-@click.group()
-def cli(): pass
\ No newline at end of file
+import importlib
+from pathlib import Path
+
+class LazyGroup(click.Group):
+  ''' A click group whose subcommands are only imported when they're used,
+  each module registers its command on import through `@cli.command()`
+  '''
+  def __init__(self, *args, lazy_subcommands: dict[str, str] = {}, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.lazy_subcommands = lazy_subcommands
+
+  def list_commands(self, ctx):
+    return sorted({*super().list_commands(ctx), *self.lazy_subcommands})
+
+  def get_command(self, ctx, cmd_name):
+    if cmd_name not in self.commands and cmd_name in self.lazy_subcommands:
+      importlib.import_module(self.lazy_subcommands[cmd_name])
+    return super().get_command(ctx, cmd_name)
+
+# command name => the module defining it, new commands should be added here
+lazy_subcommands = {
+  'bench-copy': 'helper.cli.bench_copy',
+  'bench-startup': 'helper.cli.bench_startup',
+  'build-lookup': 'helper.cli.build_lookup',
+  'check-gene-set-views': 'helper.cli.check_gene_set_views',
+  'clean': 'helper.cli.clean',
+  'count-perturbations': 'helper.cli.count_perturbations',
+  'create-release': 'helper.cli.create_release',
+  'gene-ordinals-report': 'helper.cli.gene_ordinals_report',
+  'ingest': 'helper.cli.ingest',
+  'ingest-counts-fda': 'helper.cli.ingest_count_fda',
+  'ingest-gene-info': 'helper.cli.ingest_gene_info',
+  'ingest-paper-info': 'helper.cli.ingest_paper_info',
+  'match-fda-products': 'helper.cli.match_fda_products',
+  'update-background': 'helper.cli.update_background',
+  'update-counts-fda': 'helper.cli.update_fda_approved',
+}
+
+@click.group(cls=LazyGroup, lazy_subcommands=lazy_subcommands)
+@click.option('--metrics-out', type=click.Path(dir_okay=False, path_type=Path), default=None, help='Write stage timings of the command to this file')
+@click.option('--metrics-format', type=click.Choice(['jsonl', 'prometheus']), default=None, help='Format of --metrics-out, by default prometheus for .prom files and json lines otherwise')
+@click.pass_context
+def cli(ctx, metrics_out, metrics_format):
+  from helper import metrics
+  metrics.command = ctx.invoked_subcommand
+  if metrics_out is not None:
+    if metrics_format is None:
+      metrics_format = 'prometheus' if metrics_out.suffix == '.prom' else 'jsonl'
+    ctx.call_on_close(lambda: metrics.write_metrics(metrics_out, metrics_format))
+  # the whole command is also recorded as a stage
+  ctx.with_resource(metrics.stage('total'))
@@ -0,0 +1,91 @@
+import click
+from helper.cli import cli
+
+def synthetic_genes(n_genes: int):
+  import uuid
+  return [
+    dict(id=str(uuid.uuid4()), symbol=f"GENE{i}", ordinal=i + 1)
+    for i in range(n_genes)
+  ]
+
+def synthetic_gene_sets(genes: list[dict], n_gene_sets: int, gene_set_size: int):
+  import json
+  import uuid
+  import random
+  for i in range(n_gene_sets):
+    gene_set_genes = random.sample(genes, gene_set_size)
+    gene_set = [gene['id'] for gene in gene_set_genes]
+    yield dict(
+      term=f"TERM{i}",
+      description=f"Synthetic gene set {i}",
+      hash=uuid.uuid5(uuid.UUID('00000000-0000-0000-0000-000000000000'), '\t'.join(sorted(gene_set))),
+      gene_ids=json.dumps({gene_id: position for position, gene_id in enumerate(gene_set)}),
+      gene_ordinals=[gene['ordinal'] for gene in gene_set_genes],
+      n_gene_ids=len(gene_set),
+    )
+
+def csv_records(records: list[dict]):
+  ''' The csv COPY parses arrays from their text form, lists are written as array literals
+  '''
+  return [
+    {k: '{' + ','.join(map(str, v)) + '}' if isinstance(v, list) else v for k, v in record.items()}
+    for record in records
+  ]
+
+@cli.command()
+@click.option('--n-genes', type=click.IntRange(min=1), default=20000, help='Number of synthetic genes')
+@click.option('--n-gene-sets', type=click.IntRange(min=1), default=10000, help='Number of synthetic gene sets')
+@click.option('--gene-set-size', type=click.IntRange(min=1), default=250, help='Genes per synthetic gene set')
+@click.option('--repeats', type=click.IntRange(min=1), default=3, help='Timed runs per format, the best is reported')
+@click.option('--connections', type=click.IntRange(min=1), default=1, help='Also time `copy_from_records_parallel` with this many connections')
+def bench_copy(n_genes, n_gene_sets, gene_set_size, repeats, connections):
+  ''' Compare csv and binary `copy_from_records` throughput on synthetic `gene` and `gene_set` rows.
+  Rows are copied into temporary tables shaped like the real ones, nothing is persisted.
+  '''
+  import time
+  import functools
+  from helper.plpy import plpy, connect
+  from helper.utils import copy_from_records, copy_from_records_parallel
+  genes = synthetic_genes(n_genes)
+  gene_sets = list(synthetic_gene_sets(genes, n_gene_sets, min(gene_set_size, n_genes)))
+  benchmarks = [
+    ('gene', ('id', 'symbol', 'ordinal'), dict(csv=csv_records(genes), binary=genes)),
+    ('gene_set', ('term', 'description', 'hash', 'gene_ids', 'gene_ordinals', 'n_gene_ids'), dict(csv=csv_records(gene_sets), binary=gene_sets)),
+  ]
+  # like doesn't copy the identity of gene.ordinal, only its not null, so the ordinals are
+  #  generated here along with the gene sets' gene_ordinals
+  for table, _, _ in benchmarks:
+    plpy.execute(f"create temporary table bench_{table} (like app_public_v2.{table} including defaults)", [])
+  plpy.conn.commit()
+  try:
+    methods = [
+      (format, format, functools.partial(copy_from_records, plpy.conn, format=format))
+      for format in ('csv', 'binary')
+    ]
+    if connections > 1:
+      def copy_parallel(table, columns, records, format):
+        return copy_from_records_parallel(
+          plpy.conn, connect,
+          table, columns, records, format=format,
+          # a few chunks per connection so they stay busy
+          n_connections=connections, chunk_size=max(1, len(records) // (connections * 4)),
+        )
+      methods += [
+        (f"{format}x{connections}", format, functools.partial(copy_parallel, format=format))
+        for format in ('csv', 'binary')
+      ]
+    for table, columns, records_by_format in benchmarks:
+      for label, format, copy in methods:
+        records = records_by_format[format]
+        elapsed = float('inf')
+        for _ in range(repeats):
+          plpy.execute(f"truncate bench_{table}", [])
+          plpy.conn.commit()
+          start = time.perf_counter()
+          copy(f"bench_{table}", columns, records)
+          elapsed = min(elapsed, time.perf_counter() - start)
+        click.echo(f"{table:>8} {label:>9}: {len(records)/elapsed:12.0f} rows/s ({elapsed:.3f}s for {len(records)} rows)")
+  finally:
+    for table, _, _ in benchmarks:
+      plpy.execute(f"drop table if exists bench_{table}", [])
+    plpy.conn.commit()
@@ -0,0 +1,44 @@
+import click
+from helper.cli import cli
+
+@cli.command(context_settings=dict(ignore_unknown_options=True))
+@click.option('--budget', type=click.FloatRange(min=0, min_open=True), default=0.5, help='Maximum median startup time in seconds')
+@click.option('--repeats', type=click.IntRange(min=1), default=5, help='Number of fresh interpreters to time')
+@click.option('--top', type=click.IntRange(min=0), default=10, help='Number of slowest imports to show')
+@click.argument('args', nargs=-1, type=click.UNPROCESSED)
+def bench_startup(budget, repeats, top, args):
+  ''' Time `python -m helper --help` (or `python -m helper ARGS...`) in fresh interpreters and
+  fail if the median exceeds the budget. No database is made available, startup must not need one.
+  '''
+  import os
+  import re
+  import sys
+  import time
+  import statistics
+  import subprocess
+  from pathlib import Path
+  args = args or ('--help',)
+  env = {k: v for k, v in os.environ.items() if k != 'DATABASE_URL'}
+  env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(Path(__file__).parents[2]), env.get('PYTHONPATH')]))
+  elapsed, imports = [], {}
+  for _ in range(repeats):
+    start = time.perf_counter()
+    proc = subprocess.run(
+      [sys.executable, '-X', 'importtime', '-m', 'helper', *args],
+      env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    elapsed.append(time.perf_counter() - start)
+    if proc.returncode != 0:
+      raise click.ClickException(f"python -m helper {' '.join(args)} failed:\n{proc.stderr[-2000:]}")
+    # import time: self [us] | cumulative | imported package
+    for m in re.finditer(r'^import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)$', proc.stderr, re.MULTILINE):
+      cumulative, indent, module = int(m.group(1)), m.group(2), m.group(3)
+      # only top-level imports, nested ones are included in their parent's cumulative time
+      if not indent:
+        imports[module] = max(imports.get(module, 0), cumulative)
+  median = statistics.median(elapsed)
+  for module, cumulative in sorted(imports.items(), key=lambda item: -item[1])[:top]:
+    click.echo(f"{module:>40}: {cumulative/1000:8.1f} ms")
+  click.echo(f"python -m helper {' '.join(args)}: median {median*1000:.0f} ms over {repeats} runs (budget {budget*1000:.0f} ms)")
+  if median > budget:
+    raise click.ClickException(f"Startup took {median*1000:.0f} ms, over the {budget*1000:.0f} ms budget")
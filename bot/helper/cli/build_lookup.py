@@ -0,0 +1,16 @@
+import click
+from pathlib import Path
+from helper.cli import cli
+
+@cli.command()
+@click.option('-i', '--input', type=click.Path(exists=True, file_okay=True, path_type=Path), default='lookup.json', help='JSON object mapping gene synonyms to symbols')
+@click.option('-o', '--output', type=click.Path(path_type=Path), default='lookup.idx', help='Output location')
+def build_lookup(input, output):
+  ''' Compile the gene lookup into an index `clean` can memory-map instead of parsing the json each time
+  '''
+  import json
+  from helper import lookup
+  with input.open('r') as fr:
+    mapping = json.load(fr)
+  lookup.build_lookup(mapping, output)
+  click.echo(f"Compiled {len(mapping)} synonyms into {output} ({output.stat().st_size / 1024 / 1024:.1f} MiB)")
@@ -0,0 +1,48 @@
+import click
+from helper.cli import cli
+
+# each incrementally maintained table alongside the query which computes it from scratch
+views = {
+  'app_public_v2.gene_set_pmc': ('id, pmc', '''
+    select gs.id, app_private_v2.gene_set_term_pmc(gs.term) as pmc
+    from app_public_v2.gene_set gs
+  '''),
+  'app_public_v2.gene_set_fda_counts': ('id, perturbation, count, approved, moa', '''
+    select gs.id, fda.perturbation, fda.count, fda.approved, fda.moa
+    from app_public_v2.gene_set gs
+    inner join app_public_v2.fda_counts fda
+    on app_private_v2.gene_set_term_perturbation(gs.term) = fda.perturbation
+  '''),
+}
+
+@cli.command()
+@click.option('--fix', is_flag=True, default=False, help='Rebuild any table which is inconsistent')
+def check_gene_set_views(fix):
+  ''' Verify the trigger maintained gene_set_pmc & gene_set_fda_counts tables against a full recompute.
+  '''
+  from helper.plpy import plpy
+  inconsistent = []
+  for table, (columns, recompute) in views.items():
+    result, = plpy.cursor(f'''
+      with expected as ({recompute}), actual as (select {columns} from {table})
+      select
+        (select count(*) from (select * from actual except all select * from expected) extra) as n_extra,
+        (select count(*) from (select * from expected except all select * from actual) missing) as n_missing
+    ''')
+    click.echo(f"{table}: {result['n_extra']} extra, {result['n_missing']} missing")
+    if result['n_extra'] or result['n_missing']:
+      inconsistent.append(table)
+  if inconsistent and fix:
+    try:
+      for table in inconsistent:
+        columns, recompute = views[table]
+        plpy.execute(f"delete from {table}", [])
+        plpy.execute(f"insert into {table} ({columns}) {recompute}", [])
+        click.echo(f"{table}: rebuilt")
+    except:
+      plpy.conn.rollback()
+      raise
+    else:
+      plpy.conn.commit()
+  elif inconsistent:
+    raise click.ClickException(f"Inconsistent: {', '.join(inconsistent)}, use --fix to rebuild")
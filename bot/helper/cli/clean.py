@@ -1,8 +1,11 @@
+import re
 import click
 from pathlib import Path
 from helper.cli import cli
 
 lookup = None
+whitespace = re.compile(r'\s')
+numeric = re.compile(r'\d+(\.\d+)?')
 
 def unique(L):
   S = set()
@@ -13,40 +16,80 @@ def unique(L):
     L_.append(el)
   return L_
 
+def init_lookup(lookup_path: Path):
+  ''' Open the lookup, this is done once per worker process
+  '''
+  global lookup
+  from helper.lookup import open_lookup
+  lookup = open_lookup(lookup_path)
+
+def gene_lookup(value):
+  ''' Don't allow pure numbers or spaces--numbers can typically match entrez ids
+  '''
+  if type(value) != str: return None
+  if whitespace.search(value): return None
+  if numeric.match(value): return None
+  return lookup(value)
+
+def clean_lines(lines: list[str]):
+  ''' Map the genes of GMT lines, returning the (term, genes) of those which pass the filters,
+  terms are deduplicated by the caller since they can repeat across chunks
+  '''
+  gene_sets = []
+  for line in filter(None, map(str.strip, lines)):
+    term, _, *geneset = line.split('\t')
+    geneset_mapped = unique([gene_mapped for gene in geneset for gene_mapped in (gene_lookup(gene),) if gene_mapped])
+    if (
+      len(geneset_mapped) >= 5
+      and len(geneset_mapped) < 2500
+      and len(term) < 200
+    ):
+      gene_sets.append((term, geneset_mapped))
+  return gene_sets
+
 @cli.command()
 @click.option('-i', '--input', type=click.Path(exists=True, file_okay=True, path_type=Path), help='GMT file to clean')
 @click.option('-o', '--output', type=click.Path(path_type=Path), help='Output location')
-def clean(input, output):
-  import re
-  def gene_lookup(value):
-    ''' Don't allow pure numbers or spaces--numbers can typically match entrez ids
-    '''
-    if type(value) != str: return None
-    if re.search(r'\s', value): return None
-    if re.match(r'\d+(\.\d+)?', value): return None
-    global lookup
-    if lookup is None:
-      import json
-      with open('lookup.json', 'r') as fr:
-        lookup = json.load(fr).get
-    return lookup(value)
+@click.option('--lookup', 'lookup_path', type=click.Path(exists=True, file_okay=True, path_type=Path), default=None, help='Gene lookup, compiled with build-lookup or json, defaults to lookup.idx if it exists otherwise lookup.json')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=None, help='Worker processes, defaults to the number of cpus with a compiled lookup and 1 with a json lookup')
+@click.option('--chunk-size', type=click.IntRange(min=1), default=1000, help='Lines per chunk handed to a worker')
+def clean(input, output, lookup_path, jobs, chunk_size):
+  import os
+  import functools
+  from concurrent.futures import ProcessPoolExecutor
+  from helper.utils import chunked, ordered_map
+  from helper.lookup import is_compiled_lookup
+  if lookup_path is None:
+    lookup_path = Path('lookup.idx') if Path('lookup.idx').exists() else Path('lookup.json')
+  if jobs is None:
+    if is_compiled_lookup(lookup_path):
+      jobs = os.cpu_count() or 1
+    else:
+      # every worker would parse & hold its own copy of the json lookup
+      click.echo(f"{lookup_path} isn't compiled, cleaning in one process, see build-lookup", err=True)
+      jobs = 1
 
   terms = set()
   with input.open('r') as fr:
     with output.open('w') as fw:
-      for line in filter(None, map(str.strip, fr)):
-        term, _, *geneset = line.split('\t')
-        geneset_mapped = unique([gene_mapped for gene in geneset for gene_mapped in (gene_lookup(gene),) if gene_mapped])
-        if (
-          len(geneset_mapped) >= 5
-          and len(geneset_mapped) < 2500
-          and len(term) < 200
-          and term not in terms
-        ):
-          terms.add(term)
-          print(
-            term, '',
-            *geneset_mapped,
-            sep='\t',
-            file=fw,
-          )
+      chunks = chunked(fr, chunk_size)
+      if jobs == 1:
+        init_lookup(lookup_path)
+        cleaned_chunks = map(clean_lines, chunks)
+      else:
+        pool = ProcessPoolExecutor(jobs, initializer=functools.partial(init_lookup, lookup_path))
+        cleaned_chunks = ordered_map(pool, clean_lines, chunks, window=jobs * 2)
+      try:
+        for cleaned_chunk in cleaned_chunks:
+          for term, geneset_mapped in cleaned_chunk:
+            if term in terms: continue
+            terms.add(term)
+            print(
+              term, '',
+              *geneset_mapped,
+              sep='\t',
+              file=fw,
+            )
+      finally:
+        if jobs != 1:
+          pool.shutdown(cancel_futures=True)
@@ -0,0 +1,77 @@
+import click
+from pathlib import Path
+from helper.cli import cli
+
+# l1000 signature terms: batch_cell_time_plate_perturbation[_dose] up|down, the terms of gene
+#  sets from PMC articles can have underscores in them too
+L1000_TERM = r'^(?!PMC\d)[^_]+_[^_]+_[^_]+_[^_]+_[^_]+(_[^_]+)? (up|down)$'
+
+def compute_perturbation_counts(plpy, fda_approved: list[str] | None = None, prune=False):
+  ''' Count the gene sets of each perturbation straight from the gene set terms and write them
+  to fda_counts, so the counts always match what was actually ingested. Perturbations are keyed
+  like gene_set_fda_counts joins them, gene knockouts keep their trailing space.
+  Only perturbations whose values changed are written, so the fda_counts triggers only
+  refresh the gene sets of those.
+  :param fda_approved: Drug names to mark as approved, by default approvals are left as they are
+  :param prune: Remove perturbations which no longer have any gene sets, this includes those
+    which were only annotated (e.g. with a MOA)
+  :returns: (upserted, removed)
+  '''
+  from helper import metrics
+  with metrics.stage('count_perturbations') as s:
+    with plpy.conn.cursor() as cur:
+      cur.execute('''
+        insert into app_public_v2.fda_counts as fda (perturbation, count, approved)
+        select
+          gs.perturbation,
+          count(*),
+          coalesce(upper(gs.perturbation) = any(%(fda_approved)s::text[]), false)
+        from (
+          select app_private_v2.gene_set_term_perturbation(gs.term) as perturbation
+          from app_public_v2.gene_set gs
+          where gs.term ~ %(l1000_term)s
+        ) gs
+        -- the crispr controls
+        where gs.perturbation not like 'BRDN%%'
+        group by gs.perturbation
+        on conflict (perturbation) do update
+        set
+          count = excluded.count,
+          approved = case when %(fda_approved)s::text[] is null then fda.approved else excluded.approved end
+        where fda.count is distinct from excluded.count
+        or (%(fda_approved)s::text[] is not null and fda.approved is distinct from excluded.approved)
+      ''', dict(fda_approved=fda_approved, l1000_term=L1000_TERM))
+      upserted = cur.rowcount
+      removed = 0
+      if prune:
+        cur.execute('''
+          delete from app_public_v2.fda_counts fda
+          where not exists (
+            select 1
+            from app_public_v2.gene_set gs
+            where app_private_v2.gene_set_term_perturbation(gs.term) = fda.perturbation
+            and gs.term ~ %(l1000_term)s
+          )
+        ''', dict(l1000_term=L1000_TERM))
+        removed = cur.rowcount
+    s.add(rows=upserted + removed)
+  return upserted, removed
+
+@cli.command()
+@click.option('--fda-approved', type=click.Path(exists=True, dir_okay=False, path_type=Path), default=None, help='A json list of FDA approved drug names, by default approvals are left as they are')
+@click.option('--prune', is_flag=True, default=False, help="Remove perturbations which no longer have any gene sets, even annotated ones")
+def count_perturbations(fda_approved, prune):
+  ''' Recompute the perturbation signature counts in fda_counts from the ingested gene sets
+  '''
+  import json
+  from helper.plpy import plpy
+  if fda_approved is not None:
+    fda_approved = [drug.upper() for drug in json.loads(fda_approved.read_text())]
+  try:
+    upserted, removed = compute_perturbation_counts(plpy, fda_approved=fda_approved, prune=prune)
+  except:
+    plpy.conn.rollback()
+    raise
+  else:
+    plpy.conn.commit()
+    print(f"{upserted} perturbations updated, {removed} removed")
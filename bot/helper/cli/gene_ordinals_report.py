@@ -0,0 +1,78 @@
+import click
+from helper.cli import cli
+
+@cli.command()
+@click.option('--n-genes', type=click.IntRange(min=1), default=100, help='Size of the random gene list used for timing queries')
+@click.option('--repeats', type=click.IntRange(min=1), default=5, help='Timed runs per query, the best is reported')
+def gene_ordinals_report(n_genes, repeats):
+  ''' Compare the storage & query latency of gene set genes as a jsonb
+  object of gene uuids (`gene_ids`) versus an array of gene ordinals (`gene_ordinals`).
+  '''
+  import time
+  from helper.plpy import plpy
+
+  sizes, = plpy.cursor('''
+    select
+      count(*) as n_gene_sets,
+      sum(pg_column_size(gs.gene_ids)) as gene_ids_bytes,
+      sum(pg_column_size(gs.gene_ordinals)) as gene_ordinals_bytes,
+      pg_relation_size('app_public_v2.gene_set_gene_ids_idx') as gene_ids_idx_bytes,
+      pg_relation_size('app_public_v2.gene_set_gene_ordinals_idx') as gene_ordinals_idx_bytes
+    from app_public_v2.gene_set gs
+  ''')
+  click.echo(f"{sizes['n_gene_sets']} gene sets")
+  for label, column_bytes, index_bytes in [
+    ('gene_ids', sizes['gene_ids_bytes'], sizes['gene_ids_idx_bytes']),
+    ('gene_ordinals', sizes['gene_ordinals_bytes'], sizes['gene_ordinals_idx_bytes']),
+  ]:
+    click.echo(f"{label:>14}: column {(column_bytes or 0)/1024/1024:10.1f} MiB, index {index_bytes/1024/1024:10.1f} MiB")
+
+  genes = [
+    row['symbol']
+    for row in plpy.cursor(
+      plpy.prepare('select symbol from app_public_v2.gene order by random() limit $1', ['int']),
+      [n_genes],
+    )
+  ]
+  queries = [
+    ('overlap gene_ids', '''
+      select gs.id, count(*)
+      from (
+        select distinct gm.gene_id::text as gene_id
+        from app_public_v2.gene_map($1) gm
+      ) ig
+      inner join app_public_v2.gene_set gs on gs.gene_ids ? ig.gene_id
+      group by gs.id
+    ''', [genes]),
+    ('overlap gene_ordinals', '''
+      select gs.id, count(*)
+      from (
+        select distinct g.ordinal
+        from app_public_v2.gene_map($1) gm
+        inner join app_public_v2.gene g on g.id = gm.gene_id
+      ) ig
+      inner join app_public_v2.gene_set gs on gs.gene_ordinals @> array[ig.ordinal]
+      group by gs.id
+    ''', [genes]),
+    ('genes gene_ids', '''
+      select g.*
+      from (select gene_ids from app_public_v2.gene_set limit 1000) gs,
+        jsonb_each(gs.gene_ids) gsg(gene_id, position)
+      inner join app_public_v2.gene g on gsg.gene_id = g.id::text
+    ''', []),
+    ('genes gene_ordinals', '''
+      select g.*
+      from (select gene_ordinals from app_public_v2.gene_set limit 1000) gs,
+        unnest(gs.gene_ordinals) gsg(ordinal)
+      inner join app_public_v2.gene g on gsg.ordinal = g.ordinal
+    ''', []),
+  ]
+  for label, query, args in queries:
+    query = plpy.prepare(query, ['varchar[]'] * len(args))
+    elapsed = float('inf')
+    for _ in range(repeats):
+      start = time.perf_counter()
+      for _ in plpy.cursor(query, args): pass
+      elapsed = min(elapsed, time.perf_counter() - start)
+    click.echo(f"{label:>22}: {elapsed*1000:10.1f} ms")
+  plpy.conn.rollback()
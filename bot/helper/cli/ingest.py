@@ -2,105 +2,378 @@ import click
 from pathlib import Path
 from tqdm import tqdm
 from helper.cli import cli
-from helper.utils import copy_from_records
+from helper.utils import copy_from_records, chunked, peak_rss
+from helper import metrics
+from helper.gene_cache import GeneCache
 
-def import_gene_set_library(
-  plpy,
-  library: Path | str,
-  prefix='',
-  postfix='',
-):
+def parse_gene_set(line: str, prefix='', postfix=''):
+  ''' Parse a single GMT line into a gene set record, None if it isn't a valid gene set
+  '''
   import re
-  import json
   import uuid
+  line_split = line.strip().split('\t')
+  if len(line_split) < 3: return None
+  term, description, *raw_genes = line_split
+  genes = [
+    cleaned_gene
+    for raw_gene in map(str.strip, raw_genes)
+    if raw_gene
+    for cleaned_gene in (re.split(r'[;,:\s]', raw_gene)[0],)
+    if cleaned_gene
+  ]
+  return dict(
+    term=prefix+term+postfix,
+    description=description,
+    genes=genes,
+    hash=uuid.uuid5(uuid.UUID('00000000-0000-0000-0000-000000000000'), '\t'.join(sorted(set(genes)))),
+  )
+
+def iter_gene_sets(library: Path | str, prefix='', postfix='', offset=0):
+  ''' Lazily parse the gene sets in a GMT file starting from the byte `offset`,
+  each gene set has the byte offset just past its line in `offset`
+  '''
+  with Path(library).open('rb') as fr:
+    fr.seek(offset)
+    for line in fr:
+      offset += len(line)
+      gene_set = parse_gene_set(line.decode(), prefix=prefix, postfix=postfix)
+      if gene_set is not None:
+        gene_set['offset'] = offset
+        yield gene_set
+
+def resolve_genes(plpy, genes: set[str], gene_map: dict[str, tuple[str, int]], gene_cache: GeneCache | None = None):
+  ''' Ensure all `genes` are present in `gene_map` as (gene_id, gene_ordinal), resolving them
+  with the `gene_cache` if provided, then the database and inserting any genes that we've never seen before.
+  '''
+  import uuid
+  genes = genes - gene_map.keys()
+  if not genes: return
+
+  if gene_cache is not None:
+    gene_map.update(gene_cache.get_many(genes))
+    genes = genes - gene_map.keys()
+    if not genes: return
 
-  # fetch the gene_set, gather the background genes
-  new_gene_sets = []
-  background_genes = set()
-  n_geneset_genes = 0
-  with Path(library).open('r') as fr:
-    for line in tqdm(fr, desc='Loading gmt...'):
-      line_split = line.strip().split('\t')
-      if len(line_split) < 3: continue
-      term, description, *raw_genes = line_split
-      genes = [
-        cleaned_gene
-        for raw_gene in map(str.strip, raw_genes)
-        if raw_gene
-        for cleaned_gene in (re.split(r'[;,:\s]', raw_gene)[0],)
-        if cleaned_gene
-      ]
-      new_gene_sets.append(dict(
-        term=prefix+term+postfix,
-        description=description,
-        genes=genes,
-        hash=uuid.uuid5(uuid.UUID('00000000-0000-0000-0000-000000000000'), '\t'.join(sorted(set(genes)))),
-      ))
-      background_genes.update(genes)
-      n_geneset_genes += len(genes)
-
-  # get a mapping from background_genes to background_gene_ids
-  gene_map, = plpy.cursor(
+  # get a mapping from genes to gene_ids, if a gene maps to several the last one is kept
+  resolved = {
+    row['gene']: (row['gene_id'], row['gene_ordinal'])
+    for row in plpy.cursor(
+      plpy.prepare(
+        '''
+          select gm.gene, g.id::text as gene_id, g.ordinal as gene_ordinal
+          from app_public_v2.gene_map($1) as gm
+          inner join app_public_v2.gene g on g.id = gm.gene_id
+        ''',
+        ['varchar[]']
+      ),
+      [list(genes)]
+    )
+  }
+  gene_map.update(resolved)
+  if gene_cache is not None:
+    gene_cache.update(resolved)
+
+  # upsert any new genes not in the mapping & add them to the mapping
+  genes = genes - gene_map.keys()
+  if not genes: return
+  # reserve ordinals for the new genes so we know them without reading them back
+  ordinals = plpy.cursor(
     plpy.prepare(
       '''
-        select coalesce(jsonb_object_agg(g.gene, g.gene_id), '{}') as gene_map
-        from app_public_v2.gene_map($1) as g
+        select nextval(pg_get_serial_sequence('app_public_v2.gene', 'ordinal')) as ordinal
+        from generate_series(1, $1)
       ''',
-      ['varchar[]']
+      ['int']
     ),
-    [list(background_genes)]
+    [len(genes)]
   )
-  gene_map = json.loads(gene_map['gene_map'])
-
-  # upsert any new genes not in the mapping & add them to the mapping
   new_genes = {
-    id: dict(id=id, symbol=gene)
-    for gene in tqdm(background_genes - gene_map.keys(), desc='Preparing new genes...')
+    id: dict(id=id, symbol=gene, ordinal=ordinal['ordinal'])
+    for gene, ordinal in zip(tqdm(genes, desc='Preparing new genes...', leave=False), ordinals)
     for id in (str(uuid.uuid4()),)
   }
-  if new_genes:
-    copy_from_records(
-      plpy.conn, 'app_public_v2.gene', ('id', 'symbol',),
-      tqdm(new_genes.values(), desc='Inserting new genes...'))
-    gene_map.update({
-      new_gene['symbol']: new_gene['id']
-      for new_gene in new_genes.values()
-    })
-
-  existing = {
-    (row['term'], row['description'], row['hash'])
-    for row in plpy.cursor('select term, description, hash from app_public_v2.gene_set', tuple())
+  with metrics.stage('insert_genes') as s:
+    s.add(
+      rows=len(new_genes),
+      bytes=copy_from_records(
+        plpy.conn, 'app_public_v2.gene', ('id', 'symbol', 'ordinal',),
+        tqdm(new_genes.values(), desc='Inserting new genes...', leave=False),
+        format='binary', commit=False),
+    )
+  new_gene_map = {
+    new_gene['symbol']: (new_gene['id'], new_gene['ordinal'])
+    for new_gene in new_genes.values()
   }
+  gene_map.update(new_gene_map)
+  if gene_cache is not None:
+    gene_cache.inserted(plpy, new_gene_map)
+
+def parse_gene_set_library(library: Path | str, prefix='', postfix=''):
+  ''' Parse all gene sets in a GMT file, this is used in worker processes
+  '''
+  return list(iter_gene_sets(library, prefix=prefix, postfix=postfix))
+
+def create_gene_set_staging(plpy):
+  ''' Candidate gene sets are staged in a session-local table and only those
+  not already in the database are inserted, this way we never need to
+  pull the existing gene sets out of the database
+  '''
+  plpy.execute('''
+    create temporary table gene_set_staging (
+      term varchar not null,
+      description varchar,
+      hash uuid not null,
+      gene_ids jsonb not null,
+      gene_ordinals int4[] not null,
+      n_gene_ids int not null
+    )
+  ''', [])
 
-  copy_from_records(
-    plpy.conn, 'app_public_v2.gene_set', ('term', 'description', 'hash', 'gene_ids', 'n_gene_ids'),
+def gene_set_record(gene_set, gene_map: dict[str, tuple[str, int]]):
+  ''' Construct the database record of a parsed gene set
+  '''
+  import json
+  # genes are stored in the order they appear in the gmt, if a gene appears
+  #  more than once (possibly through different synonyms) the last position is used
+  gene_positions = {gene_map[gene]: position for position, gene in enumerate(gene_set['genes'])}
+  return dict(
+    term=gene_set['term'],
+    # empty descriptions are stored as null
+    description=gene_set['description'] or None,
+    hash=gene_set['hash'],
+    gene_ids=json.dumps({gene_id: position for (gene_id, _), position in gene_positions.items()}),
+    gene_ordinals=[gene_ordinal for (_, gene_ordinal), _ in sorted(gene_positions.items(), key=lambda item: item[1])],
+    n_gene_ids=len(gene_set['genes']),
+  )
+
+def stage_gene_sets(plpy, gene_sets, gene_map: dict[str, tuple[str, int]], **kwargs) -> int:
+  ''' Copy gene sets into the staging table, all of their genes should be in `gene_map`
+  :returns: The number of bytes copied
+  '''
+  return copy_from_records(
+    plpy.conn, 'gene_set_staging', ('term', 'description', 'hash', 'gene_ids', 'gene_ordinals', 'n_gene_ids'),
     tqdm((
-      dict(
-        term=gene_set['term'],
-        description=gene_set['description'],
-        hash=gene_set['hash'],
-        gene_ids=json.dumps({gene_map[gene]: position for position, gene in enumerate(gene_set['genes'])}),
-        n_gene_ids=len(gene_set['genes']),
-      )
-      for gene_set in new_gene_sets
-      if (gene_set['term'], gene_set['description'], gene_set['hash']) not in existing
+      gene_set_record(gene_set, gene_map)
+      for gene_set in gene_sets
     ),
-    total=len(new_gene_sets) - len(existing),
-    desc='Inserting new genesets...'),
+    desc='Staging genesets...',
+    **kwargs),
+    format='binary',
+    commit=False,
   )
 
-  plpy.execute('refresh materialized view concurrently app_public_v2.gene_set_pmc', [])
+def insert_staged_gene_sets(plpy) -> int:
+  ''' Insert the staged gene sets which aren't already in the database and clear the staging table
+  :returns: The number of gene sets inserted
+  '''
+  inserted, = plpy.cursor('''
+    with inserted as (
+      insert into app_public_v2.gene_set (term, description, hash, gene_ids, gene_ordinals, n_gene_ids)
+      select distinct on (s.term, s.description, s.hash) s.term, s.description, s.hash, s.gene_ids, s.gene_ordinals, s.n_gene_ids
+      from gene_set_staging s
+      where not exists (
+        select 1
+        from app_public_v2.gene_set gs
+        where gs.hash = s.hash
+          and gs.term = s.term
+          and gs.description is not distinct from s.description
+      )
+      returning 1
+    )
+    select count(*) as n_inserted from inserted
+  ''', [])
+  plpy.execute('truncate gene_set_staging', [])
+  return inserted['n_inserted']
+
+def ingest_stats(start: float, n_gene_sets: int, n_inserted: int):
+  ''' Summarize an ingest which started at `start` (from `time.perf_counter`)
+  '''
+  import time
+  elapsed = time.perf_counter() - start
+  return dict(
+    n_gene_sets=n_gene_sets,
+    n_inserted=n_inserted,
+    elapsed=elapsed,
+    rows_per_second=n_gene_sets / elapsed if elapsed else 0.,
+    peak_rss=peak_rss(),
+  )
+
+def import_gene_set_library(
+  plpy,
+  library: Path | str,
+  prefix='',
+  postfix='',
+  chunk_size: int | None = None,
+  checkpoint=False,
+  resume=False,
+  gene_cache: GeneCache | None = None,
+):
+  ''' Ingest a GMT into the database.
+  :param chunk_size: When provided, the GMT is streamed in chunks of this many gene sets, each
+    chunk is resolved & inserted before the next is read so memory doesn't grow with the file.
+    Otherwise the whole file is loaded before anything is written.
+  :param checkpoint: Commit after every chunk, recording progress in app_private_v2.ingest_checkpoint,
+    otherwise nothing is committed and the caller commits (or rolls back) the whole ingest
+  :param resume: Continue from the last checkpoint of this file, if its content hasn't changed
+  :param gene_cache: A local cache of resolved genes to consult before the database
+  :returns: statistics about the ingest
+  '''
+  import time
+  from helper.checkpoint import content_hash, load_checkpoint, save_checkpoint
+
+  start = time.perf_counter()
+  offset = 0
+  n_gene_sets = 0
+  if checkpoint:
+    source, library_hash = str(Path(library).resolve()), content_hash(library)
+    last_checkpoint = load_checkpoint(plpy, source, library_hash) if resume else None
+    if last_checkpoint is not None:
+      if last_checkpoint['completed']:
+        print(f"{library} was already ingested")
+        return ingest_stats(start, 0, 0)
+      offset, n_gene_sets = last_checkpoint['byte_offset'], last_checkpoint['n_records']
+      print(f"Resuming {library} after {n_gene_sets} gene sets")
+
+  gene_sets = iter_gene_sets(library, prefix=prefix, postfix=postfix, offset=offset)
+  if chunk_size:
+    chunks = chunked(tqdm(gene_sets, desc='Streaming gmt...', initial=n_gene_sets), chunk_size)
+    # reading & parsing happens lazily as chunks are consumed
+    chunks = metrics.timed('parse', chunks, rows=len)
+  else:
+    with metrics.stage('parse') as s:
+      chunks = [list(tqdm(gene_sets, desc='Loading gmt...'))]
+      s.add(rows=len(chunks[0]), bytes=Path(library).stat().st_size - offset)
+
+  create_gene_set_staging(plpy)
+  gene_map = {}
+  n_inserted = 0
+  for chunk in chunks:
+    n_gene_sets += len(chunk)
+    with metrics.stage('resolve_genes'):
+      resolve_genes(plpy, {gene for gene_set in chunk for gene in gene_set['genes']}, gene_map, gene_cache)
+    with metrics.stage('stage_gene_sets') as s:
+      s.add(rows=len(chunk), bytes=stage_gene_sets(plpy, chunk, gene_map, total=len(chunk), leave=not chunk_size))
+    with metrics.stage('insert_gene_sets') as s:
+      n_chunk_inserted = insert_staged_gene_sets(plpy)
+      s.add(rows=n_chunk_inserted)
+    n_inserted += n_chunk_inserted
+    if checkpoint:
+      with metrics.stage('checkpoint'):
+        save_checkpoint(plpy, source, library_hash, chunk[-1]['offset'], n_gene_sets)
+        plpy.conn.commit()
+  plpy.execute('drop table gene_set_staging', [])
+  if checkpoint:
+    save_checkpoint(plpy, source, library_hash, Path(library).stat().st_size, n_gene_sets, completed=True)
+
+  return ingest_stats(start, n_gene_sets, n_inserted)
+
+def import_gene_set_libraries(
+  plpy,
+  libraries: list[Path],
+  prefix='',
+  postfix='',
+  jobs: int | None = None,
+  gene_cache: GeneCache | None = None,
+):
+  ''' Ingest several GMTs into the database at once.
+  The GMTs are parsed in parallel by a process pool, then genes across all of them are resolved
+  in one round trip and all gene sets are loaded with one COPY. Nothing is committed, the new
+  genes and gene sets are committed (or rolled back) together by the caller.
+  :param jobs: The number of worker processes to parse with, defaults to the number of cpus
+  :param gene_cache: A local cache of resolved genes to consult before the database
+  :returns: statistics about the ingest
+  '''
+  import time
+  import functools
+  from concurrent.futures import ProcessPoolExecutor
+
+  start = time.perf_counter()
+  with metrics.stage('parse') as s, ProcessPoolExecutor(jobs) as pool:
+    libraries_gene_sets = list(tqdm(
+      pool.map(functools.partial(parse_gene_set_library, prefix=prefix, postfix=postfix), libraries),
+      total=len(libraries),
+      desc='Parsing gmts...',
+    ))
+    n_gene_sets = sum(map(len, libraries_gene_sets))
+    s.add(rows=n_gene_sets, bytes=sum(library.stat().st_size for library in libraries))
+
+  gene_map = {}
+  with metrics.stage('resolve_genes'):
+    resolve_genes(plpy, {
+      gene
+      for gene_sets in libraries_gene_sets
+      for gene_set in gene_sets
+      for gene in gene_set['genes']
+    }, gene_map, gene_cache)
+
+  create_gene_set_staging(plpy)
+  with metrics.stage('stage_gene_sets') as s:
+    s.add(rows=n_gene_sets, bytes=stage_gene_sets(plpy, (
+      gene_set
+      for gene_sets in libraries_gene_sets
+      for gene_set in gene_sets
+    ), gene_map, total=n_gene_sets))
+  with metrics.stage('insert_gene_sets') as s:
+    n_inserted = insert_staged_gene_sets(plpy)
+    s.add(rows=n_inserted)
+  plpy.execute('drop table gene_set_staging', [])
+
+  return ingest_stats(start, n_gene_sets, n_inserted)
 
 @cli.command()
 @click.option('-i', '--input', type=click.Path(exists=True, file_okay=True, path_type=Path), help='GMT file to ingest')
+@click.option('--input-dir', type=click.Path(exists=True, file_okay=False, path_type=Path), help='Directory of GMT files to ingest together')
+@click.option('--glob', type=str, default='*.gmt', help='Pattern for GMT files in --input-dir')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=None, help='Worker processes for parsing --input-dir, defaults to the number of cpus')
 @click.option('--prefix', type=str, default='', help='Prefix to add to terms')
 @click.option('--postfix', type=str, default='', help='Postfix to add to terms')
-def ingest(input, prefix, postfix):
+@click.option('--chunk-size', type=click.IntRange(min=1), default=None, help='Stream the GMT in chunks of this many gene sets to bound memory usage')
+@click.option('--batch-size', type=click.IntRange(min=1), default=None, help='Stream the GMT in batches of this many gene sets, committing and checkpointing after each')
+@click.option('--resume', is_flag=True, default=False, help='Continue from the last checkpoint of this GMT, requires --batch-size')
+@click.option('--gene-cache', 'gene_cache_path', type=click.Path(dir_okay=False, path_type=Path), default='data/gene_cache.sqlite3', help='Local cache of resolved gene symbols, discarded when genes change in the database')
+@click.option('--no-gene-cache', is_flag=True, default=False, help='Resolve all gene symbols with the database')
+def ingest(input, input_dir, glob, jobs, prefix, postfix, chunk_size, batch_size, resume, gene_cache_path, no_gene_cache):
+  if (input is None) == (input_dir is None):
+    raise click.UsageError('Exactly one of -i/--input or --input-dir is required')
+  if chunk_size and batch_size:
+    raise click.UsageError('--chunk-size and --batch-size are mutually exclusive')
+  if resume and not batch_size:
+    raise click.UsageError('--resume requires --batch-size')
+  if input_dir is not None and batch_size:
+    raise click.UsageError('--batch-size is not supported with --input-dir')
+  if input_dir is not None:
+    libraries = sorted(input_dir.glob(glob))
+    if not libraries:
+      raise click.UsageError(f"No files matching {glob} in {input_dir}")
   from helper.plpy import plpy
+  gene_cache = None
+  if not no_gene_cache:
+    gene_cache = GeneCache(gene_cache_path)
+    gene_cache.validate(plpy)
   try:
-    import_gene_set_library(plpy, input, prefix=prefix, postfix=postfix)
+    if input_dir is not None:
+      stats = import_gene_set_libraries(plpy, libraries, prefix=prefix, postfix=postfix, jobs=jobs, gene_cache=gene_cache)
+    else:
+      stats = import_gene_set_library(
+        plpy, input, prefix=prefix, postfix=postfix,
+        chunk_size=batch_size or chunk_size,
+        checkpoint=bool(batch_size),
+        resume=resume,
+        gene_cache=gene_cache,
+      )
   except:
     plpy.conn.rollback()
     raise
   else:
     plpy.conn.commit()
+    # the cache is only persisted once what it describes is committed
+    if gene_cache is not None:
+      gene_cache.save()
+  finally:
+    if gene_cache is not None:
+      gene_cache.close()
+  click.echo(
+    f"Ingested {stats['n_inserted']} new of {stats['n_gene_sets']} gene sets"
+    f" in {stats['elapsed']:.1f}s ({stats['rows_per_second']:.0f} rows/s),"
+    f" peak memory {stats['peak_rss'] / 1024 / 1024:.0f} MiB"
+  )
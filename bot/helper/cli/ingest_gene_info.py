@@ -1,8 +1,10 @@
+import click
 import urllib.request
 from tqdm import tqdm
 from pathlib import Path
 from helper.cli import cli
-from helper.utils import copy_from_records
+from helper import metrics
+from helper.kvstore import KVStore
 
 def ensure_gene_info(organism='Mammalia/Homo_sapiens'):
   gene_info_path = Path(f"{organism}.gene_info.gz")
@@ -11,60 +13,102 @@ def ensure_gene_info(organism='Mammalia/Homo_sapiens'):
     urllib.request.urlretrieve(f"https://ftp.ncbi.nlm.nih.gov/gene/DATA/GENE_INFO/{organism}.gene_info.gz", gene_info_path)
   return gene_info_path
 
-def try_fetch_json(url, tries=1):
-  import time
-  import json
-  import traceback
-  time.sleep(0.5)
-  for _ in range(tries):
-    try:
-      with urllib.request.urlopen(url) as fr:
-        return json.load(fr)
-    except KeyboardInterrupt:
-      raise
-    except:
-      traceback.print_exc()
-      time.sleep(5)
+def fetch_gene_summaries(
+  gene_ids: list[str],
+  store: KVStore,
+  chunk_size=100,
+  concurrency=8,
+  rate=None,
+  eutils_url='https://eutils.ncbi.nlm.nih.gov/entrez/eutils',
+):
+  ''' Fetch NCBI gene summaries into `store` (GeneID -> summary), chunks are requested
+  concurrently as fast as the rate limit allows, and each is stored as soon as it arrives so
+  an interrupted fetch can resume.
+  :param rate: Requests per second, NCBI allows 3 or 10 with an NCBI_API_KEY
+  '''
+  import os
+  from helper.utils import chunked
+  from helper.fetch import RateLimitedSession, map_concurrent
+  api_key = os.environ.get('NCBI_API_KEY')
+  session = RateLimitedSession(rate or (10 if api_key else 3), concurrency=concurrency)
+  def fetch_chunk(chunk_genes):
+    params = dict(db='gene', id=','.join(chunk_genes), retmode='json')
+    if api_key: params['api_key'] = api_key
+    return session.get_json(f"{eutils_url}/esummary.fcgi", params=params)
+  failed = 0
+  with session, tqdm(total=len(gene_ids), desc='Fetching gene summaries...') as pbar:
+    for chunk_genes, data in map_concurrent(fetch_chunk, chunked(gene_ids, chunk_size), concurrency):
+      if isinstance(data, Exception):
+        failed += 1
+        tqdm.write(f"Failed to fetch {len(chunk_genes)} gene summaries: {data!r}")
+      else:
+        store.set_many({
+          g: data['result'][g].get('summary', '') if g in data['result'] else ''
+          for g in chunk_genes
+        })
+        store.commit()
+      pbar.update(len(chunk_genes))
+  if failed:
+    raise RuntimeError(f"{failed} chunks of gene summaries failed, run again to resume")
 
-def ensure_gene_summary(chunk_size=100):
+def ensure_gene_summary(chunk_size=100, concurrency=8, rate=None):
   # Primary credit to https://www.biostars.org/p/2144/
   # I modified it to:
   #  1. work with python3
   #  2. use the ncbi ftp gene_info file as input
   #  3. try again if API returns an error
-  import numpy as np
+  #  4. fetch concurrently under the rate limit & resume from an on-disk store
+  import os
   import pandas as pd
 
   gene_summary_path = Path('data/Homo_sapiens.gene_summary.tsv')
-  gene_info = pd.read_csv(ensure_gene_info(), sep='\t', compression='gzip')
-  gene_ids = gene_info['GeneID'].unique()
-  if gene_summary_path.exists():
-    results = pd.read_csv(gene_summary_path, sep='\t')
-    gene_ids = np.setdiff1d(gene_ids, results['GeneID'].unique())
-  #
-  for i in tqdm(range(0, len(gene_ids), chunk_size), desc='Fetching gene summaries...'):
-    chunk_genes = gene_ids[i:min(i+chunk_size, len(gene_ids))]
-    gids = ','.join([str(s) for s in chunk_genes])
-    url = f'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?db=gene&id={gids}&retmode=json';
-    data = try_fetch_json(url, 3)
-    result = []
-    for g in chunk_genes:
-      result.append([g, data['result'][str(g)]['summary'] if str(g) in data['result'] else ''])
-    pd.DataFrame(result, columns=['GeneID', 'summary']).to_csv(gene_summary_path, index=False, mode='a', sep='\t', header=(i==0))
+  store = KVStore(gene_summary_path.with_suffix('.sqlite3'), table='gene_summary')
+  try:
+    gene_info = pd.read_csv(ensure_gene_info(), sep='\t', compression='gzip', usecols=['GeneID'])
+    gene_ids = [str(g) for g in gene_info['GeneID'].unique()]
+    if len(store) == 0 and gene_summary_path.exists():
+      # carry over summaries fetched before the store existed
+      results = pd.read_csv(gene_summary_path, sep='\t', dtype=str, keep_default_na=False)
+      results = results[results['GeneID'] != 'GeneID']
+      store.set_many(dict(zip(results['GeneID'], results['summary'])))
+      store.commit()
+    missing = store.missing(gene_ids)
+    if missing:
+      fetch_gene_summaries(
+        missing, store,
+        chunk_size=chunk_size, concurrency=concurrency, rate=rate,
+        eutils_url=os.environ.get('EUTILS_URL', 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'),
+      )
+    if missing or not gene_summary_path.exists():
+      summaries = store.get_many(gene_ids)
+      pd.DataFrame(
+        [[g, summaries[g]] for g in gene_ids],
+        columns=['GeneID', 'summary'],
+      ).to_csv(gene_summary_path, index=False, sep='\t')
+  finally:
+    store.close()
   return gene_summary_path
 
-def ensure_gene_info_complete():
-  gene_info_complete_path = Path('data/Homo_sapiens.gene_info.complete.tsv')
+def ensure_gene_info_complete(**summary_kwargs):
+  ''' The columns of the gene info we use along with the gene summaries, this is stored as
+  parquet so it can be read back column-wise without parsing text
+  '''
+  gene_info_complete_path = Path('data/Homo_sapiens.gene_info.complete.parquet')
   if not gene_info_complete_path.exists():
     import pandas as pd
     #
-    df = pd.read_csv(ensure_gene_info(), sep='\t', compression='gzip')
-    df_summary = pd.read_csv(ensure_gene_summary(), sep='\t')
+    df = pd.read_csv(
+      ensure_gene_info(), sep='\t', compression='gzip',
+      usecols=['GeneID', 'Symbol', 'description'],
+      dtype=dict(GeneID='Int64', Symbol=str, description=str),
+    )
+    df_summary = pd.read_csv(
+      ensure_gene_summary(**summary_kwargs), sep='\t',
+      dtype=dict(GeneID='Int64', summary=str),
+    )
     #
     df = df.dropna(subset=['GeneID'])
-    df['GeneID'] = df['GeneID'].astype(str)
     df_summary = df_summary.dropna(subset=['GeneID'])
-    df_summary['GeneID'] = df_summary['GeneID'].astype(str)
     #
     df_out = pd.merge(
       left=df,
@@ -73,47 +117,73 @@ def ensure_gene_info_complete():
       right_on='GeneID',
       how='left',
     )
-    df_out.to_csv(gene_info_complete_path, sep='\t')
+    gene_info_complete_path.parent.mkdir(parents=True, exist_ok=True)
+    df_out[['Symbol', 'GeneID', 'description', 'summary']].to_parquet(gene_info_complete_path, index=False)
   #
   return gene_info_complete_path
 
-def import_gene_info(plpy):
+def import_gene_info(plpy, batch_size=None, resume=False, **summary_kwargs):
+  ''' Fill in the description & summary of genes which don't have them
+  :param batch_size: Upsert this many genes at a time, committing and checkpointing after each batch,
+    otherwise all genes are upserted at once
+  :param resume: Continue from the last checkpoint, if the gene info table hasn't changed
+  :param summary_kwargs: Options for fetching gene summaries, see `ensure_gene_summary`
+  '''
   import pandas as pd
-  df = pd.read_csv(ensure_gene_info_complete(), sep='\t')
-  symbols = set(df['Symbol'].unique())
+  from helper.utils import copy_from_dataframe
+  from helper.checkpoint import content_hash, load_checkpoint, save_checkpoint
+  with metrics.stage('load') as s:
+    gene_info_complete_path = ensure_gene_info_complete(**summary_kwargs)
+    df = pd.read_parquet(gene_info_complete_path, columns=['Symbol', 'GeneID', 'description', 'summary'])
+    s.add(rows=df.shape[0], bytes=gene_info_complete_path.stat().st_size)
   genes_without_info = [
-    row['symbol']
-    for row in plpy.cursor('''
+    symbol
+    for symbol, in plpy.cursor('''
       select symbol
       from app_public_v2.gene
       where description is null or summary is null
-    ''', tuple())
-    if row['symbol'] in symbols
+    ''', tuple(), tuples=True, itersize=10000)
   ]
-  df = df.drop_duplicates(subset='Symbol').set_index('Symbol').loc[genes_without_info, ['GeneID', 'description', 'summary']]
+  # the index is the row number in the gene info table which we use for checkpoints
+  df = df.drop_duplicates(subset='Symbol')
+  df = df.loc[df['Symbol'].isin(genes_without_info)]
+  df = df.rename(columns=dict(Symbol='symbol', GeneID='ncbi_gene_id'))
 
-  if df.shape[0] > 0:
-    copy_from_records(
-      plpy.conn, 'app_public_v2.gene', ('symbol', 'ncbi_gene_id', 'description', 'summary'),
-      tqdm((
-        dict(
-          symbol=symbol,
-          ncbi_gene_id=row['GeneID'],
-          description=row['description'],
-          summary=row['summary'],
-        )
-        for symbol, row in df.iterrows()
-      ),
-      total=df.shape[0],
-      desc='Inserting gene info'),
-      on_conflict_update=('symbol',),
-    )
+  if batch_size:
+    source, source_hash = str(gene_info_complete_path.resolve()), content_hash(gene_info_complete_path)
+    last_checkpoint = load_checkpoint(plpy, source, source_hash) if resume else None
+    if last_checkpoint is not None:
+      print(f"Resuming after row {last_checkpoint['n_records']}")
+      df = df.loc[df.index >= last_checkpoint['n_records']]
+    batches = [df.iloc[i:i+batch_size] for i in range(0, df.shape[0], batch_size)]
+  else:
+    batches = [df]
+
+  for batch_df in tqdm(batches, desc='Inserting gene info'):
+    if batch_df.shape[0] == 0: continue
+    with metrics.stage('upsert') as s:
+      s.add(rows=batch_df.shape[0], bytes=copy_from_dataframe(
+        plpy.conn, 'app_public_v2.gene', batch_df,
+        on_conflict_update=('symbol',),
+      ))
+    if batch_size:
+      with metrics.stage('checkpoint'):
+        save_checkpoint(plpy, source, source_hash, 0, int(batch_df.index[-1]) + 1)
+        plpy.conn.commit()
+  if batch_size:
+    save_checkpoint(plpy, source, source_hash, 0, int(df.index[-1]) + 1 if df.shape[0] else 0, completed=True)
 
 @cli.command()
-def ingest_gene_info():
+@click.option('--batch-size', type=click.IntRange(min=1), default=None, help='Upsert this many genes at a time, committing and checkpointing after each batch')
+@click.option('--resume', is_flag=True, default=False, help='Continue from the last checkpoint, requires --batch-size')
+@click.option('--concurrency', type=click.IntRange(min=1), default=8, help='Concurrent gene summary requests')
+@click.option('--rate', type=click.FloatRange(min=0, min_open=True), default=None, help='Gene summary requests per second, defaults to the NCBI limit (3, or 10 with NCBI_API_KEY)')
+def ingest_gene_info(batch_size, resume, concurrency, rate):
+  if resume and not batch_size:
+    raise click.UsageError('--resume requires --batch-size')
   from helper.plpy import plpy
   try:
-    import_gene_info(plpy)
+    import_gene_info(plpy, batch_size=batch_size, resume=resume, concurrency=concurrency, rate=rate)
   except:
     plpy.conn.rollback()
     raise
@@ -1,17 +1,122 @@
+import click
 import traceback
 from tqdm import tqdm
+from pathlib import Path
 from helper.cli import cli
 from helper.utils import copy_from_records
 
-def import_paper_info(plpy):
-  import pandas as pd
+PMC_IDS_URL = 'https://ftp.ncbi.nlm.nih.gov/pub/pmc/PMC-ids.csv.gz'
+
+def ensure_pmc_ids(pmc_ids_path=Path('data/PMC-ids.csv.gz'), url=PMC_IDS_URL):
+  ''' Keep a local copy of the PMC bulk download metadata table, it's only downloaded
+  again if the server reports it changed since our copy (ETag / Last-Modified)
+  '''
+  import json
   import requests
+  from helper.fetch import RateLimitedSession
+  meta_path = pmc_ids_path.with_name(pmc_ids_path.name + '.meta.json')
+  headers = {}
+  if pmc_ids_path.exists() and meta_path.exists():
+    meta = json.loads(meta_path.read_text())
+    if meta.get('etag'): headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'): headers['If-Modified-Since'] = meta['last_modified']
+  # retried like the other NCBI requests, the session is kept open while the body streams
+  with RateLimitedSession() as session:
+    try:
+      res = session.get(url, headers=headers, stream=True)
+    except requests.RequestException:
+      if not pmc_ids_path.exists(): raise
+      traceback.print_exc()
+      print('Failed to refresh PMC-ids, using the cached copy')
+      return pmc_ids_path
+    with res:
+      if res.status_code == 304:
+        return pmc_ids_path
+      pmc_ids_path.parent.mkdir(parents=True, exist_ok=True)
+      tmp = pmc_ids_path.with_name(pmc_ids_path.name + '.tmp')
+      with tmp.open('wb') as fw:
+        with tqdm(total=int(res.headers.get('Content-Length', 0)) or None, unit='B', unit_scale=True, desc='Downloading PMC-ids...') as pbar:
+          for block in res.iter_content(1<<20):
+            fw.write(block)
+            pbar.update(len(block))
+      tmp.replace(pmc_ids_path)
+      meta_path.write_text(json.dumps(dict(
+        etag=res.headers.get('ETag'),
+        last_modified=res.headers.get('Last-Modified'),
+      )))
+  return pmc_ids_path
+
+def read_pmc_meta(pmc_ids_path: Path, pmcids: set[str], chunksize=500_000):
+  ''' Read the PMC metadata of `pmcids` from the PMC-ids table, the table is parsed in chunks
+  and only matching rows are kept so memory doesn't grow with the size of the table
+  '''
+  import pandas as pd
+  return pd.concat([
+    chunk[chunk.index.isin(pmcids)]
+    for chunk in pd.read_csv(
+      pmc_ids_path,
+      usecols=['PMCID', 'Year', 'DOI'],
+      dtype=dict(PMCID=str, Year='Int64', DOI=str),
+      index_col='PMCID',
+      chunksize=chunksize,
+    )
+  ])
+
+def fetch_pmc_titles(
+  pmcids: list[str],
+  batch_size=250,
+  concurrency=4,
+  retries=5,
+  backoff=1.,
+  rate=None,
+  eutils_url=None,
+):
+  ''' Resolve the titles of PMC articles with esummary, several batches are kept in flight over
+  a pooled session and (pmcid, title) pairs are yielded as batches complete.
+  Each batch is retried up to `retries` times, batches which still fail are skipped and
+  reported once the rest are done.
+  :param rate: Requests per second, NCBI allows 3 or 10 with an NCBI_API_KEY
+  :param eutils_url: Defaults to EUTILS_URL or NCBI's E-utilities
+  '''
+  import os
   import re
+  from helper.fetch import RateLimitedSession, map_concurrent
+  from helper.utils import chunked
+  eutils_url = eutils_url or os.environ.get('EUTILS_URL', 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils')
+  api_key = os.environ.get('NCBI_API_KEY')
+  session = RateLimitedSession(rate or (10 if api_key else 3), concurrency=concurrency, retries=retries, backoff=backoff)
+
+  def fetch_batch(batch):
+    params = dict(db='pmc', retmode='json', id=','.join(re.sub(r"^PMC(\d+)$", r"\1", id) for id in batch))
+    if api_key: params['api_key'] = api_key
+    ids_info = session.get_json(f"{eutils_url}/esummary.fcgi", params=params)
+    return {
+      f"PMC{id}": ids_info['result'][id]['title']
+      for id in ids_info['result']['uids']
+      if 'title' in ids_info['result'].get(id, {})
+    }
+
+  failed = []
+  with session:
+    for batch, titles in map_concurrent(fetch_batch, chunked(pmcids, batch_size), concurrency):
+      if isinstance(titles, Exception):
+        print(f"Error resolving info of {len(batch)} articles: {titles!r}")
+        failed.append(titles)
+        continue
+      yield from titles.items()
+  if failed:
+    raise RuntimeError(f"{len(failed)} batches failed to resolve with the E-utilities api, run again to retry them")
 
+def import_paper_info(plpy, pmc_ids_path: Path | None = None, **title_kwargs):
+  ''' Add year, doi & title of the papers that gene sets come from
+  :param pmc_ids_path: A local copy of PMC-ids.csv(.gz), by default a cached copy is kept up to date
+  :param title_kwargs: Options for fetching titles, see `fetch_pmc_titles`
+  '''
+  import pandas as pd
   # find subset to add info to
   to_ingest = [
-    r['pmc']
-    for r in plpy.cursor(
+    pmc
+    for pmc, in plpy.cursor(
       '''
         select pmc
         from app_public_v2.pmc
@@ -19,61 +124,47 @@ def import_paper_info(plpy):
           select pmcid
           from app_public_v2.pmc_info
         )
-      '''
+      ''',
+      tuples=True,
+      itersize=10000,
     )
   ]
 
+  if not to_ingest:
+    return
+
   # use information from bulk download metadata table (https://ftp.ncbi.nlm.nih.gov/pub/pmc/)
-  pmc_meta = pd.read_csv('https://ftp.ncbi.nlm.nih.gov/pub/pmc/PMC-ids.csv.gz', usecols=['PMCID', 'Year', 'DOI'], index_col='PMCID', compression='gzip')
-  pmc_meta = pmc_meta[pmc_meta.index.isin(to_ingest)]
+  pmc_meta = read_pmc_meta(pmc_ids_path or ensure_pmc_ids(), set(to_ingest))
   if pmc_meta.shape[0] == 0:
     return
 
-  title_dict = {}
-  for i in tqdm(range(0, len(to_ingest), 250), 'Pulling titles...'):
-    while True:
-      j = 0
-      try:
-        ids_string = ",".join([re.sub(r"^PMC(\d+)$", r"\1", id) for id in to_ingest[i:i+250]])
-        res = requests.get(f'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?db=pmc&retmode=json&id={ids_string}')
-        ids_info = res.json()
-        for id in ids_info['result']['uids']:
-          try:
-            title_dict[f"PMC{id}"] = ids_info['result'][id]['title']
-          except KeyError:
-            pass
-        break
-      except KeyboardInterrupt:
-        raise
-      except Exception as e:
-        traceback.print_exc()
-        print('Error resolving info. Retrying...')
-        j += 1
-        if j >= 10:
-          raise RuntimeError(f'Error connecting to E-utilites api...')
-
-  if title_dict:
-    copy_from_records(
-      plpy.conn, 'app_public_v2.pmc_info', ('pmcid', 'yr', 'doi', 'title'),
-      tqdm((
-        dict(
-          pmcid=pmc,
-          yr=int(pmc_meta.at[pmc, 'Year']),
-          doi=pmc_meta.at[pmc, 'DOI'],
-          title=title_dict[pmc],
-        )
-        for pmc in pmc_meta.index.values
-        if pmc in title_dict
-      ),
-      total=len(title_dict),
-      desc='Inserting PMC info..')
-    )
+  # titles are written into the COPY as they're resolved, so loading overlaps with fetching.
+  #  If some batches fail the others are still loaded and the next run picks up the rest.
+  copy_from_records(
+    plpy.conn, 'app_public_v2.pmc_info', ('pmcid', 'yr', 'doi', 'title'),
+    tqdm((
+      dict(
+        pmcid=pmc,
+        # Year is nullable (Int64), missing years are pd.NA
+        yr=None if pd.isna(year) else int(year),
+        doi=doi if isinstance(doi, str) else None,
+        title=title,
+      )
+      for pmc, title in fetch_pmc_titles(list(pmc_meta.index.values), **title_kwargs)
+      for year, doi in ((pmc_meta.at[pmc, 'Year'], pmc_meta.at[pmc, 'DOI']),)
+    ),
+    total=pmc_meta.shape[0],
+    desc='Inserting PMC info..')
+  )
 
 @cli.command()
-def ingest_paper_info():
+@click.option('--pmc-ids', 'pmc_ids_path', type=click.Path(exists=True, dir_okay=False, path_type=Path), default=None, help='Local PMC-ids.csv(.gz) to use instead of the cached download')
+@click.option('--concurrency', type=click.IntRange(min=1), default=4, help='Batches of titles to request at once')
+@click.option('--rate', type=click.FloatRange(min=0, min_open=True), default=None, help='Title requests per second, defaults to the NCBI limit (3, or 10 with NCBI_API_KEY)')
+def ingest_paper_info(pmc_ids_path, concurrency, rate):
   from helper.plpy import plpy
   try:
-    import_paper_info(plpy)
+    import_paper_info(plpy, pmc_ids_path=pmc_ids_path, concurrency=concurrency, rate=rate)
   except:
     plpy.conn.rollback()
     raise
@@ -0,0 +1,48 @@
+import click
+from pathlib import Path
+from helper.cli import cli
+
+def match_products(perturbations: list[str], product_names: list[str]) -> list[tuple[str, str]]:
+  ''' Pair each perturbation with the first product name containing it (case insensitively),
+  perturbations which aren't in any product name are left out. Product names are only scanned
+  once for all perturbations.
+  '''
+  from tqdm import tqdm
+  from helper.aho_corasick import AhoCorasick
+  matcher = AhoCorasick(p.lower() for p in perturbations)
+  first_product = {}
+  for product_name in tqdm(product_names, desc='Matching products...'):
+    for i in matcher.find_all(product_name.lower()):
+      first_product.setdefault(i, product_name)
+    if len(first_product) == len(perturbations):
+      break
+  return [
+    (p, first_product[i])
+    for i, p in enumerate(perturbations)
+    if i in first_product
+  ]
+
+@cli.command()
+@click.option('--perturbations', type=click.Path(exists=True, dir_okay=False, path_type=Path), default='data/counts_perts.json', help='Json object keyed by the l1000 perturbations')
+@click.option('--products', type=click.Path(exists=True, dir_okay=False, path_type=Path), default='data/Products.txt', help='Drugs@FDA Products.txt')
+@click.option('--fda-approved', type=click.Path(exists=True, dir_okay=False, path_type=Path), default='data/fda_approved.json', help='Json list of the already known FDA approved drugs')
+@click.option('-o', '--output', type=click.Path(dir_okay=False, path_type=Path), default='data/fda_approved_new.json', help='Where to write the union of known and matched FDA approved drugs')
+def match_fda_products(perturbations, products, fda_approved, output):
+  ''' Find the l1000 perturbations which are part of an FDA product name, and add them to the known FDA approved drugs
+  '''
+  import json
+  import pandas as pd
+  perturbations = list(json.loads(perturbations.read_text()))
+  fda_approved = set(json.loads(fda_approved.read_text()))
+  df = pd.read_csv(products, sep='\t', index_col=0, on_bad_lines='warn')
+  product_names = list(dict.fromkeys(df['DrugName'].dropna()))
+  pair_list = match_products(perturbations, product_names)
+  l1000_approved = {p.upper() for p, _ in pair_list}
+  print('intersection', len(l1000_approved & fda_approved))
+  print('new', len(l1000_approved))
+  print('og', len(fda_approved))
+  print('diff', len(l1000_approved - fda_approved))
+  union = l1000_approved | fda_approved
+  print('union', len(union))
+  output.parent.mkdir(parents=True, exist_ok=True)
+  output.write_text(json.dumps(sorted(union)))
@@ -1,34 +1,142 @@
 import click
 from helper.cli import cli
 
+def warm_index(enrich_url: str, background_id: str, timeout=3600., poll=5.):
+  ''' Start building the enrich index of a background and wait until it's ready.
+  The enrich API builds the index while the request which asked for it is open, so that
+  request is kept open in a thread while the status of the index is polled.
+  :param timeout: Seconds to wait for the index before giving up
+  :param poll: Seconds between status checks
+  '''
+  import time
+  import threading
+  import requests
+  errors = []
+  def build():
+    try:
+      res = requests.get(f"{enrich_url}/{background_id}", timeout=timeout)
+      res.raise_for_status()
+    except requests.RequestException as e:
+      errors.append(e)
+  builder = threading.Thread(target=build, daemon=True)
+  builder.start()
+  start = time.monotonic()
+  status = None
+  while True:
+    try:
+      res = requests.get(f"{enrich_url}/{background_id}/status", timeout=poll)
+      status = res.json()
+    except (requests.RequestException, ValueError) as e:
+      # the api may be busy or restarting, keep trying until the timeout
+      status = dict(status=f"unreachable ({type(e).__name__})")
+    elapsed = time.monotonic() - start
+    if status.get('status') == 'ready':
+      print(f"[{background_id}] ready after {elapsed:.0f}s: {status['columns']} genes, {status['index']} gene sets")
+      return status
+    if errors:
+      raise RuntimeError(f"Failed to build the index of {background_id}") from errors[0]
+    if elapsed > timeout:
+      raise TimeoutError(f"The index of {background_id} wasn't ready after {timeout:.0f}s ({status.get('status')})")
+    print(f"[{background_id}] {status.get('status')} ({elapsed:.0f}s)")
+    time.sleep(poll)
+
+def drain_queries(plpy, since, timeout=60., poll=1.):
+  ''' Wait for the transactions which started before `since` to finish, these could have
+  resolved the previous current_background() and still be querying the enrich API with it.
+  Transactions of other roles are only visible with pg_read_all_stats.
+  :param since: The database time after which transactions see the new background
+  :param timeout: Seconds to wait for the transactions before giving up on them
+  :param poll: Seconds between checks
+  :returns: The number of transactions still open when the wait ended
+  '''
+  import time
+  start = time.monotonic()
+  while True:
+    n_queries, = plpy.cursor('''
+      select count(*) as n_queries
+      from pg_stat_activity
+      where datname = current_database()
+      and backend_type = 'client backend'
+      and pid <> pg_backend_pid()
+      and xact_start < %s
+    ''', [since], server_side=False)
+    # pg_stat_activity is snapshotted once per transaction
+    plpy.conn.rollback()
+    elapsed = time.monotonic() - start
+    if n_queries['n_queries'] == 0:
+      print(f"Queries on the old background(s) drained after {elapsed:.0f}s")
+      return 0
+    if elapsed > timeout:
+      print(f"{n_queries['n_queries']} queries on the old background(s) still running after {timeout:.0f}s, retiring anyway")
+      return n_queries['n_queries']
+    time.sleep(poll)
+
 @cli.command()
 @click.option('--enrich-url', envvar='ENRICH_URL', default='http://127.0.0.1:8000')
-def update_background(enrich_url):
+@click.option('--incremental', is_flag=True, default=False, help='Extend the latest background with newly referenced genes instead of taking a snapshot, genes no longer referenced are kept')
+@click.option('--timeout', type=click.FloatRange(min=0, min_open=True), default=3600., help='Seconds to wait for the new index to be ready')
+@click.option('--poll', type=click.FloatRange(min=0, min_open=True), default=5., help='Seconds between index status checks')
+@click.option('--drain', type=click.FloatRange(min=0), default=60., help='Most seconds to wait for queries started before the switch to finish before removing the old background')
+def update_background(enrich_url, incremental, timeout, poll, drain):
   ''' A background is tied to a complete set of genes across all gene sets
   but also to a computed index in the enrich API. This function creates a
-  new one, and drops the old one after ensuring the index is ready.
+  new one, switches current_background() to it once its index is ready,
+  and drops the old ones after queries on them have drained.
+
+  The genes come from app_private_v2.gene_usage which is kept up to date as
+  gene sets are ingested, so this doesn't need to expand every gene set.
   '''
   import requests
+  from helper import metrics
   from helper.plpy import plpy
   # record current backgrounds
-  current_backgrounds = [row['id'] for row in plpy.cursor('select id from app_public_v2.background')]  # create updated background
-  new_background, = plpy.cursor('''
-    insert into app_public_v2.background (gene_ids, n_gene_ids)
-    select
-      jsonb_object_agg(distinct gsg.gene_id, null) as gene_ids,
-      count(distinct gsg.gene_id) as n_gene_ids
-    from app_public_v2.gene_set gs, jsonb_each(gs.gene_ids) gsg(gene_id, nil)
-    returning id;
-  ''')
-  plpy.conn.commit()
-  # trigger index creation for the new background
-  assert requests.get(f"{enrich_url}/{new_background['id']}").ok
-  # remove old backgrounds
-  plpy.execute(
-    plpy.prepare('delete from app_public_v2.background where id = any($1::uuid[])', ['text[]']),
-    [current_backgrounds]
-  )
-  plpy.conn.commit()
-  # remove index for the old background
-  for current_background in current_backgrounds:
-    requests.delete(f"{enrich_url}/{current_background}")
+  current_backgrounds = [row['id'] for row in plpy.cursor('select id from app_public_v2.background')]
+  # create updated background
+  with metrics.stage('create_background') as s:
+    base = None
+    if incremental:
+      base = next(iter(plpy.cursor('''
+        select b.id
+        from app_public_v2.background b
+        inner join app_private_v2.background_gene_usage bgu on bgu.background_id = b.id
+        order by b.created desc
+        limit 1
+      ''')), None)
+      if base is None:
+        print('No background to extend, creating a snapshot instead')
+    if base is None:
+      new_background, = plpy.cursor('select id, n_gene_ids from app_private_v2.create_background()', server_side=False)
+    else:
+      new_background, = plpy.cursor(
+        'select id, n_gene_ids from app_private_v2.create_background_from(%s)',
+        [base['id']],
+        server_side=False,
+      )
+    plpy.conn.commit()
+    s.add(rows=new_background['n_gene_ids'])
+  # build the index for the new background, queries keep using the current one meanwhile
+  with metrics.stage('build_index'):
+    warm_index(enrich_url, new_background['id'], timeout=timeout, poll=poll)
+  with metrics.stage('switch_background'):
+    plpy.execute('select app_private_v2.set_current_background(%s)', [new_background['id']])
+    plpy.conn.commit()
+    # transactions starting from now on see the new background
+    switched, = plpy.cursor('select clock_timestamp() as switched', server_side=False)
+    plpy.conn.rollback()
+  # queries which resolved the old background just before the switch can still be on
+  #  their way to the enrich API, wait for them to finish before its index goes away
+  with metrics.stage('drain'):
+    if current_backgrounds and drain > 0:
+      drain_queries(plpy, switched['switched'], timeout=drain, poll=min(poll, 1.))
+  with metrics.stage('retire_backgrounds') as s:
+    # remove old backgrounds
+    plpy.execute(
+      plpy.prepare('delete from app_public_v2.background where id = any($1::uuid[])', ['text[]']),
+      [current_backgrounds]
+    )
+    plpy.conn.commit()
+    # remove index for the old background, it may never have been loaded
+    for current_background in current_backgrounds:
+      res = requests.delete(f"{enrich_url}/{current_background}", timeout=60)
+      if res.status_code != 404: res.raise_for_status()
+    s.add(rows=len(current_backgrounds))
@@ -1,38 +1,44 @@
 from tqdm import tqdm
 from helper.cli import cli
-import pandas as pd
+from helper.utils import copy_from_records
 
 
 def update_count_fda_info(plpy):
+    ''' Upsert perturbation counts, FDA approval & MOA annotations in bulk. Perturbations whose
+    values didn't change are left untouched, so only the affected perturbations are refreshed
+    in gene_set_fda_counts by its triggers.
+    '''
     import json
+    import pandas as pd
     with open("benchmarking/counts_perts.json") as f:
         counts_perts = json.load(f)
     with open("benchmarking/fda_approved_new.json") as f:
-        fda_drugs = json.load(f)
-        
+        fda_drugs = set(json.load(f))
+
     moas = pd.read_csv("benchmarking/MOA_Repurposing_Hub_export.txt", sep="\t", index_col=0)
-    
-    # Construct SQL query
-    sql_query = """
-        INSERT INTO app_public_v2.fda_counts (perturbation, count, approved, moa)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (perturbation)
-        DO UPDATE SET
-            count = EXCLUDED.count,
-            approved = EXCLUDED.approved,
-            moa = EXCLUDED.moa;
-    """
+    moas = moas.loc[~moas.index.duplicated(), "MOA"].dropna().to_dict()
+
+    copy_from_records(
+        plpy.conn,
+        "app_public_v2.fda_counts",
+        ("perturbation", "count", "approved", "moa"),
+        tqdm(
+            (
+                dict(
+                    perturbation=pert,
+                    count=int(counts_perts[pert]),
+                    approved=pert.upper() in fda_drugs,
+                    moa=moas.get(pert),
+                )
+                for pert in counts_perts
+            ),
+            total=len(counts_perts),
+            desc="Inserting chemical perturbation info..",
+        ),
+        on_conflict_update=("perturbation",),
+        format="binary",
+    )
 
-    # Prepare data as a list of tuples
-    data = [
-        (pert, int(counts_perts[pert]), pert.upper() in fda_drugs, moas.loc[pert]['MOA'] if pert in moas.index else None)
-        for pert in counts_perts
-    ]
-    # Execute in chunks if necessary
-    with plpy.conn.cursor() as cursor:
-        for row in tqdm(data, desc="Inserting chemical perturbation info.."):
-            cursor.execute(sql_query, row)
-        
 @cli.command()
 def update_counts_fda():
     from helper.plpy import plpy
@@ -0,0 +1,127 @@
+import time
+import typing as t
+
+if t.TYPE_CHECKING:
+  import requests
+
+T = t.TypeVar('T')
+R = t.TypeVar('R')
+
+# statuses worth retrying, anything else is a problem with the request itself
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class RateLimiter:
+  ''' A thread-safe token bucket, allows `rate` acquisitions per second on average with
+  bursts of up to `capacity`
+  '''
+  def __init__(self, rate: float, capacity: int = 1):
+    import threading
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = float(capacity)
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    with self.lock:
+      while True:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        time.sleep((1 - self.tokens) / self.rate)
+
+class RateLimitedSession:
+  ''' A pooled requests session shared by several threads, every request waits for the rate
+  limit and transient failures are retried with jittered exponential backoff (or as long as
+  the server asks with Retry-After)
+  :param rate: Requests per second, None for no limit
+  :param concurrency: Connections kept per host, the number of threads using the session
+  '''
+  def __init__(
+    self,
+    rate: float | None = None,
+    concurrency=1,
+    retries=5,
+    backoff=1.,
+    max_backoff=60.,
+    timeout=60.,
+  ):
+    import requests
+    import requests.adapters
+    self.limiter = RateLimiter(rate) if rate else None
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.timeout = timeout
+    self.session = requests.Session()
+    self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+  def close(self):
+    self.session.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _request(self, method: str, url: str, decode: t.Callable[['requests.Response'], R], **kwargs) -> R:
+    import random
+    import requests
+    kwargs.setdefault('timeout', self.timeout)
+    for attempt in range(self.retries):
+      if self.limiter is not None:
+        self.limiter.acquire()
+      delay = None
+      try:
+        res = self.session.request(method, url, **kwargs)
+        res.raise_for_status()
+        return decode(res)
+      except requests.HTTPError as e:
+        if e.response.status_code not in RETRY_STATUS or attempt + 1 == self.retries: raise
+        retry_after = e.response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit(): delay = float(retry_after)
+      except (requests.RequestException, ValueError):
+        # connection problems & truncated responses
+        if attempt + 1 == self.retries: raise
+      if delay is None:
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.)
+      time.sleep(delay)
+
+  def request(self, method: str, url: str, **kwargs) -> 'requests.Response':
+    ''' Make a request once the rate limit allows it, `kwargs` are those of `requests.request`
+    '''
+    return self._request(method, url, lambda res: res, **kwargs)
+
+  def get(self, url: str, **kwargs) -> 'requests.Response':
+    return self.request('GET', url, **kwargs)
+
+  def post(self, url: str, **kwargs) -> 'requests.Response':
+    return self.request('POST', url, **kwargs)
+
+  def get_json(self, url: str, **kwargs):
+    ''' GET json from a url, responses which aren't valid json are retried too
+    '''
+    return self._request('GET', url, lambda res: res.json(), **kwargs)
+
+def map_concurrent(
+  fn: t.Callable[[T], R],
+  items: t.Iterable[T],
+  concurrency: int,
+) -> t.Iterator[tuple[T, R | Exception]]:
+  ''' Run `fn` on each item in `concurrency` threads, yielding (item, result) in order,
+  failures are yielded as the exception rather than raised so one failure doesn't lose the rest
+  '''
+  from concurrent.futures import ThreadPoolExecutor
+  from helper.utils import ordered_map
+  def run(item):
+    try:
+      return item, fn(item)
+    except Exception as e:
+      return item, e
+  with ThreadPoolExecutor(concurrency) as pool:
+    yield from ordered_map(pool, run, items, window=concurrency * 2)
@@ -0,0 +1,73 @@
+import typing as t
+from pathlib import Path
+
+class GeneCache:
+  ''' An on-disk cache of symbol -> (gene_id, gene_ordinal) as resolved by `app_public_v2.gene_map`.
+  The cache is stamped with app_private_v2.gene_version, if the database's stamp differs
+  the cache is discarded, so it's only ever used against the mapping it was built from.
+  '''
+  def __init__(self, path: Path | str):
+    import sqlite3
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    self.db = sqlite3.connect(path)
+    self.db.executescript('''
+      create table if not exists stamp (epoch text not null, version integer not null);
+      create table if not exists gene (symbol text primary key, gene_id text not null, gene_ordinal integer not null);
+    ''')
+    self.stamp = self.db.execute('select epoch, version from stamp').fetchone()
+
+  def _set_stamp(self, stamp: tuple[str, int]):
+    self.db.execute('delete from stamp')
+    self.db.execute('insert into stamp (epoch, version) values (?, ?)', stamp)
+    self.stamp = stamp
+
+  @staticmethod
+  def current_stamp(plpy) -> tuple[str, int]:
+    row, = plpy.cursor('select epoch::text, version from app_private_v2.gene_version')
+    return (row['epoch'], row['version'])
+
+  def validate(self, plpy):
+    ''' Discard the cache if the gene mapping in the database has changed since it was stamped
+    '''
+    stamp = self.current_stamp(plpy)
+    if self.stamp != stamp:
+      self.db.execute('delete from gene')
+      self._set_stamp(stamp)
+
+  def get_many(self, symbols: t.Iterable[str], batch_size=500) -> dict[str, tuple[str, int]]:
+    from helper.utils import chunked
+    resolved = {}
+    for batch in chunked(symbols, batch_size):
+      resolved.update(
+        (symbol, (gene_id, gene_ordinal))
+        for symbol, gene_id, gene_ordinal in self.db.execute(
+          f"select symbol, gene_id, gene_ordinal from gene where symbol in ({','.join('?' * len(batch))})",
+          batch,
+        )
+      )
+    return resolved
+
+  def update(self, resolved: dict[str, tuple[str, int]]):
+    self.db.executemany(
+      'insert or replace into gene (symbol, gene_id, gene_ordinal) values (?, ?, ?)',
+      ((symbol, gene_id, gene_ordinal) for symbol, (gene_id, gene_ordinal) in resolved.items())
+    )
+
+  def inserted(self, plpy, new_genes: dict[str, tuple[str, int]]):
+    ''' Record genes which we inserted into the database ourselves. Our insert bumps the
+    version, if that's the only change since the stamp the cache remains valid.
+    New genes have no synonyms so they don't change how any other symbol maps.
+    '''
+    epoch, version = self.current_stamp(plpy)
+    if self.stamp != (epoch, version - 1):
+      # someone else changed genes concurrently
+      self.db.execute('delete from gene')
+    self._set_stamp((epoch, version))
+    self.update(new_genes)
+
+  def save(self):
+    self.db.commit()
+
+  def close(self):
+    self.db.close()
@@ -0,0 +1,53 @@
+import json
+import typing as t
+from pathlib import Path
+
+class KVStore:
+  ''' A persistent json key-value store in a sqlite file, used for resumable fetches & caches.
+  Writes only become durable on `commit`.
+  '''
+  def __init__(self, path: Path | str, table='kv'):
+    import sqlite3
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    self.db = sqlite3.connect(path)
+    self.table = table
+    self.db.execute(f"create table if not exists {self.table} (key text primary key, value text not null)")
+
+  def __len__(self):
+    n, = self.db.execute(f"select count(*) from {self.table}").fetchone()
+    return n
+
+  def get_many(self, keys: t.Iterable[str], batch_size=500) -> dict[str, t.Any]:
+    from helper.utils import chunked
+    values = {}
+    for batch in chunked(keys, batch_size):
+      values.update(
+        (key, json.loads(value))
+        for key, value in self.db.execute(
+          f"select key, value from {self.table} where key in ({','.join('?' * len(batch))})",
+          batch,
+        )
+      )
+    return values
+
+  def missing(self, keys: t.Iterable[str]) -> list[str]:
+    keys = list(keys)
+    present = self.get_many(keys).keys()
+    return [key for key in keys if key not in present]
+
+  def set_many(self, values: dict[str, t.Any]):
+    self.db.executemany(
+      f"insert or replace into {self.table} (key, value) values (?, ?)",
+      ((key, json.dumps(value)) for key, value in values.items()),
+    )
+
+  def items(self) -> t.Iterator[tuple[str, t.Any]]:
+    for key, value in self.db.execute(f"select key, value from {self.table}"):
+      yield key, json.loads(value)
+
+  def commit(self):
+    self.db.commit()
+
+  def close(self):
+    self.db.close()
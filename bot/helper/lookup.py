@@ -0,0 +1,99 @@
+import struct
+import typing as t
+from pathlib import Path
+
+# A compiled lookup is a sorted string table which can be memory-mapped & binary searched:
+#  header: magic, n_keys (u32), n_values (u32)
+#  (integers are in native byte order, the file isn't meant to be moved across architectures)
+#  key_offsets: (n_keys+1) x u32, offsets of the sorted keys in the key blob
+#  key_values: n_keys x u32, the index of each key's value
+#  value_offsets: (n_values+1) x u32, offsets of the distinct values in the value blob
+#  key blob, value blob: utf-8 encoded strings
+MAGIC = b'L2SLKP1\x00'
+HEADER = struct.Struct('=8sII')
+
+def build_lookup(lookup: dict[str, str], output: Path):
+  ''' Compile a mapping of strings into a lookup file which can be opened with `MappedLookup`
+  '''
+  import array
+  items = sorted((key.encode(), value) for key, value in lookup.items() if value is not None)
+  value_index = {}
+  key_offsets, key_values, key_blob = array.array('I', [0]), array.array('I'), bytearray()
+  value_offsets, value_blob = array.array('I', [0]), bytearray()
+  for key, value in items:
+    key_blob += key
+    key_offsets.append(len(key_blob))
+    if value not in value_index:
+      value_index[value] = len(value_index)
+      value_blob += value.encode()
+      value_offsets.append(len(value_blob))
+    key_values.append(value_index[value])
+  tmp = output.with_name(output.name + '.tmp')
+  with tmp.open('wb') as fw:
+    fw.write(HEADER.pack(MAGIC, len(key_values), len(value_index)))
+    for arr in (key_offsets, key_values, value_offsets):
+      fw.write(arr.tobytes())
+    fw.write(key_blob)
+    fw.write(value_blob)
+  tmp.replace(output)
+
+class MappedLookup:
+  ''' A read-only view of a compiled lookup file, the file is memory-mapped so opening is
+  instant and the pages are shared between processes using the same file
+  '''
+  def __init__(self, path: Path | str):
+    import mmap
+    with Path(path).open('rb') as fr:
+      self._mm = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.n_keys, self.n_values = HEADER.unpack_from(self._mm, 0)
+    if magic != MAGIC:
+      raise ValueError(f"{path} is not a compiled lookup")
+    view = memoryview(self._mm)
+    offset = HEADER.size
+    def u32s(n):
+      nonlocal offset
+      arr = view[offset:offset + 4 * n].cast('I')
+      offset += 4 * n
+      return arr
+    self._key_offsets = u32s(self.n_keys + 1)
+    self._key_values = u32s(self.n_keys)
+    self._value_offsets = u32s(self.n_values + 1)
+    self._key_blob = offset
+    self._value_blob = self._key_blob + self._key_offsets[self.n_keys]
+
+  def _key(self, i: int) -> bytes:
+    return self._mm[self._key_blob + self._key_offsets[i]:self._key_blob + self._key_offsets[i + 1]]
+
+  def _value(self, i: int) -> str:
+    return self._mm[self._value_blob + self._value_offsets[i]:self._value_blob + self._value_offsets[i + 1]].decode()
+
+  def get(self, key: str, default=None) -> t.Optional[str]:
+    k = key.encode()
+    lo, hi = 0, self.n_keys
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._key(mid) < k:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < self.n_keys and self._key(lo) == k:
+      return self._value(self._key_values[lo])
+    return default
+
+  def __len__(self):
+    return self.n_keys
+
+def is_compiled_lookup(path: Path | str):
+  with Path(path).open('rb') as fr:
+    return fr.read(len(MAGIC)) == MAGIC
+
+def open_lookup(path: Path | str) -> t.Callable[[str], t.Optional[str]]:
+  ''' Open a lookup, either compiled with `helper build-lookup` or a json object
+  :returns: the get function of the lookup
+  '''
+  if is_compiled_lookup(path):
+    return MappedLookup(path).get
+  else:
+    import json
+    with Path(path).open('r') as fr:
+      return json.load(fr).get
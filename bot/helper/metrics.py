@@ -0,0 +1,98 @@
+import time
+import contextlib
+import typing as t
+from pathlib import Path
+from helper.utils import peak_rss
+
+class Stage:
+  ''' Accumulated measurements of a stage, a stage entered several times (e.g. once per chunk)
+  accumulates its wall time, rows and bytes
+  '''
+  def __init__(self, name: str):
+    self.name = name
+    self.seconds = 0.
+    self.rows = 0
+    self.bytes = 0
+    self.peak_rss = 0
+  def add(self, rows=0, bytes=0):
+    self.rows += rows
+    self.bytes += bytes
+
+command: t.Optional[str] = None
+stages: dict[str, Stage] = {}
+
+@contextlib.contextmanager
+def stage(name: str):
+  ''' Time a stage of the current command, rows & bytes processed can be added to the yielded Stage
+  Usage:
+    with stage('parse') as s:
+      s.add(rows=len(records))
+  '''
+  s = stages.get(name)
+  if s is None:
+    s = stages[name] = Stage(name)
+  start = time.perf_counter()
+  try:
+    yield s
+  finally:
+    s.seconds += time.perf_counter() - start
+    # the process peak at the end of the stage is an upper bound of the stage's peak
+    s.peak_rss = peak_rss()
+
+def timed(name: str, iterable: t.Iterable, rows: t.Callable[[t.Any], int] = lambda _: 1):
+  ''' Attribute the time spent producing elements of `iterable` to a stage
+  '''
+  it = iter(iterable)
+  while True:
+    with stage(name) as s:
+      try:
+        el = next(it)
+      except StopIteration:
+        return
+      s.add(rows=rows(el))
+    yield el
+
+def write_jsonl(fw: t.TextIO):
+  ''' Append one json line per stage
+  '''
+  import json
+  timestamp = time.time()
+  for s in stages.values():
+    print(json.dumps(dict(
+      timestamp=timestamp,
+      command=command,
+      stage=s.name,
+      seconds=s.seconds,
+      rows=s.rows,
+      bytes=s.bytes,
+      peak_rss_bytes=s.peak_rss,
+    )), file=fw)
+
+def write_prometheus(fw: t.TextIO):
+  ''' Write the stages in the prometheus text exposition format
+  '''
+  for metric, help, attr in [
+    ('helper_stage_seconds', 'Wall time spent in the stage', 'seconds'),
+    ('helper_stage_rows', 'Rows processed in the stage', 'rows'),
+    ('helper_stage_bytes', 'Bytes processed in the stage', 'bytes'),
+    ('helper_stage_peak_rss_bytes', 'Peak resident set size of the process at the end of the stage', 'peak_rss'),
+  ]:
+    print(f"# HELP {metric} {help}", file=fw)
+    print(f"# TYPE {metric} gauge", file=fw)
+    for s in stages.values():
+      print(f'{metric}{{command="{command}",stage="{s.name}"}} {getattr(s, attr)}', file=fw)
+
+def write_metrics(path: Path, format: t.Literal['jsonl', 'prometheus']):
+  ''' Write the collected metrics, json lines are appended so a history accumulates,
+  prometheus text replaces the file (e.g. for the node_exporter textfile collector)
+  '''
+  if format == 'jsonl':
+    with path.open('a') as fw:
+      write_jsonl(fw)
+  elif format == 'prometheus':
+    tmp = path.with_name(path.name + '.tmp')
+    with tmp.open('w') as fw:
+      write_prometheus(fw)
+    tmp.replace(path)
+  else:
+    raise NotImplementedError(format)
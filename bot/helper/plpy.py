@@ -1,21 +1,53 @@
 import re
 import os
 import json
+import uuid
 import psycopg2, psycopg2.extras
 
 class PlPyCompat:
   ''' An object that works like `plpy` does when running over plpython3u
   '''
-  def __init__(self, conn) -> None:
-    self.conn = conn
-  def cursor(self, query, args=[]):
-    with self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+  def __init__(self, conn=None, itersize=2000) -> None:
+    self._conn = conn
+    self.itersize = itersize
+  @property
+  def conn(self):
+    ''' The connection is only taken from the pool once something needs the database
+    '''
+    if self._conn is None:
+      self._conn = pool().getconn()
+    return self._conn
+  def cursor(self, query, args=[], itersize=None, tuples=False, json_dumps=False, server_side=None):
+    ''' Iterate over the rows of a query.
+    Queries which only read (select/values/table) are streamed through a named server-side
+    cursor `itersize` rows at a time, so memory stays bounded and rows arrive as soon as
+    the first batch is ready. Other statements (e.g. insert ... returning) are run client-side.
+    :param tuples: Return rows as tuples rather than dicts
+    :param json_dumps: Re-encode json(b) objects as strings, like plpy does
+    :param server_side: Force a server-side (True) or client-side (False) cursor
+    '''
+    if server_side is None:
+      server_side = re.match(r'^\s*(select|values|table)\b', query, re.IGNORECASE) is not None
+    cursor_factory = None if tuples else psycopg2.extras.RealDictCursor
+    if server_side:
+      cur = self.conn.cursor(name=f"plpy_{uuid.uuid4().hex}", cursor_factory=cursor_factory)
+      cur.itersize = itersize or self.itersize
+    else:
+      cur = self.conn.cursor(cursor_factory=cursor_factory)
+    try:
       cur.execute(query, args)
-      for row in cur.fetchall():
-        yield {
-          k: json.dumps(v) if type(v) == dict else v
-          for k, v in row.items()
-        }
+      for row in cur:
+        if json_dumps:
+          if tuples:
+            row = tuple(json.dumps(v) if type(v) == dict else v for v in row)
+          else:
+            row = {k: json.dumps(v) if type(v) == dict else v for k, v in row.items()}
+        yield row
+    finally:
+      # a server-side cursor only exists until the end of its transaction, if the iteration was
+      #  abandoned and the transaction has since ended there is nothing left to close
+      if not server_side or self.conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+        cur.close()
   def execute(self, query, args=[]):
     with self.conn.cursor() as cur:
       cur.execute(query, args)
@@ -24,10 +56,27 @@ class PlPyCompat:
   def rollback(self):
     self.conn.rollback()
 
-try:
-  from dotenv import load_dotenv; load_dotenv()
-except ImportError:
-  print('Install python-dotenv for .env support')
-  
-conn = psycopg2.connect(os.environ['DATABASE_URL'])
-plpy = PlPyCompat(conn)
+_pool = None
+
+def database_url():
+  try:
+    from dotenv import load_dotenv; load_dotenv()
+  except ImportError:
+    print('Install python-dotenv for .env support')
+  return os.environ['DATABASE_URL']
+
+def connect():
+  ''' Open a new connection to the database, outside of the pool
+  '''
+  return psycopg2.connect(database_url())
+
+def pool(maxconn=8):
+  ''' The process-wide connection pool, created on first use
+  '''
+  global _pool
+  if _pool is None:
+    import psycopg2.pool
+    _pool = psycopg2.pool.ThreadedConnectionPool(0, maxconn, database_url())
+  return _pool
+
+plpy = PlPyCompat()
@@ -0,0 +1,178 @@
+import time
+import typing as t
+from pathlib import Path
+from helper.kvstore import KVStore
+
+## credit to Daniel in Playbook code
+# https://github.com/MaayanLab/Playbook-Workflow-Builder/blob/main/components/service/pubchem/__init__.py
+
+PUBCHEM_URL = 'https://pubchem.ncbi.nlm.nih.gov'
+
+class PubChem:
+  ''' Resolve drug names to PubChem CIDs (PUG id-exchange) and CIDs to FDA approval (sdq fdadrug),
+  several requests are kept in flight under a rate limit and every answer is cached so only names
+  and CIDs which haven't been seen before are looked up.
+  :param cache_path: sqlite file holding the name -> cid and cid -> approved answers
+  :param pubchem_url: Defaults to PUBCHEM_URL or PubChem itself, can point to a local fake
+  :param rate: Requests per second, PubChem asks for no more than 5
+  '''
+  def __init__(
+    self,
+    cache_path: Path | str = 'data/pubchem.sqlite3',
+    pubchem_url: str | None = None,
+    rate=5.,
+    concurrency=4,
+    retries=5,
+    backoff=1.,
+    poll=1.,
+    timeout=600.,
+  ):
+    import os
+    from helper.fetch import RateLimitedSession
+    self.pubchem_url = (pubchem_url or os.environ.get('PUBCHEM_URL', PUBCHEM_URL)).rstrip('/')
+    self.concurrency = concurrency
+    self.poll = poll
+    self.timeout = timeout
+    self.session = RateLimitedSession(rate, concurrency=concurrency, retries=retries, backoff=backoff)
+    self.name_cids = KVStore(cache_path, table='drug_name_cid')
+    self.cid_approved = KVStore(cache_path, table='cid_fda_approved')
+
+  def close(self):
+    self.session.close()
+    self.name_cids.close()
+    self.cid_approved.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _pug(self, data: str, find: str):
+    ''' Use the PUG API, and get an XML element from the response
+    '''
+    import xml.etree.ElementTree as ET
+    res = self.session.post(f"{self.pubchem_url}/pug/pug.cgi", data=data.encode())
+    root = ET.fromstring(res.content)
+    return root, root.find(find)
+
+  def fetch_name_cids(self, drug_names: list[str]) -> dict[str, str | None]:
+    ''' Given a list of drug names, get their CIDs with PubChem's API, names without a CID map to None
+    '''
+    from xml.sax.saxutils import escape
+    query_synonyms = ''.join(
+      f"<PCT-QueryUids_synonyms_E>{escape(drug)}</PCT-QueryUids_synonyms_E>"
+      for drug in drug_names
+    )
+    _, reqid = self._pug(f'''
+    <PCT-Data>
+    <PCT-Data_input>
+    <PCT-InputData>
+    <PCT-InputData_query>
+    <PCT-Query>
+    <PCT-Query_type>
+    <PCT-QueryType>
+    <PCT-QueryType_id-exchange>
+    <PCT-QueryIDExchange>
+    <PCT-QueryIDExchange_input>
+    <PCT-QueryUids>
+    <PCT-QueryUids_synonyms>{query_synonyms}</PCT-QueryUids_synonyms>
+    </PCT-QueryUids>
+    </PCT-QueryIDExchange_input>
+    <PCT-QueryIDExchange_operation-type value="same"/>
+    <PCT-QueryIDExchange_output-type value="cid"/>
+    <PCT-QueryIDExchange_output-method value="file-pair"/>
+    <PCT-QueryIDExchange_compression value="none"/>
+    </PCT-QueryIDExchange>
+    </PCT-QueryType_id-exchange>
+    </PCT-QueryType>
+    </PCT-Query_type>
+    </PCT-Query>
+    </PCT-InputData_query>
+    </PCT-InputData>
+    </PCT-Data_input>
+    </PCT-Data>
+    ''', './/PCT-Waiting_reqid')
+    if reqid is None:
+      raise RuntimeError('PubChem PUG request was not queued')
+    # the id exchange runs asynchronously, poll it until the result can be downloaded
+    deadline = time.monotonic() + self.timeout
+    while True:
+      _, download = self._pug(f'''
+      <PCT-Data>
+        <PCT-Data_input>
+          <PCT-InputData>
+            <PCT-InputData_request>
+              <PCT-Request>
+                <PCT-Request_reqid>{reqid.text}</PCT-Request_reqid>
+                <PCT-Request_type value="status"/>
+              </PCT-Request>
+            </PCT-InputData_request>
+          </PCT-InputData>
+        </PCT-Data_input>
+      </PCT-Data>
+      ''', './/PCT-Download-URL_url')
+      if download is not None: break
+      if time.monotonic() > deadline:
+        raise TimeoutError(f"PubChem PUG request {reqid.text} didn't finish after {self.timeout:.0f}s")
+      time.sleep(self.poll)
+    res = self.session.get(download.text.replace('ftp://', 'https://'))
+    name_cids = dict.fromkeys(drug_names)
+    for line in res.text.splitlines():
+      drug_name, _, cid = line.strip().partition('\t')
+      if cid: name_cids[drug_name] = cid
+    return name_cids
+
+  def fetch_fda_approvals(self, cids: list[str]) -> dict[str, bool]:
+    ''' Use PubChem's sdq API to find which compound ids are FDA approved drugs
+    '''
+    import json
+    query = {
+      'download': '*',
+      'collection': 'fdadrug',
+      'where': {'ors': [{'cid': cid} for cid in cids]},
+      'order': ['status,desc'],
+      'start': 1,
+      'limit': 10000000,
+    }
+    res = self.session.post(
+      f"{self.pubchem_url}/sdq/sdqagent.cgi",
+      params=dict(infmt='json', outfmt='json'),
+      files=dict(query=(None, json.dumps(query))),
+    )
+    # an invalid response raises rather than silently losing approvals
+    fda_cids = {str(cid) for fda_approval in res.json() for cid in fda_approval['cids']}
+    return {cid: cid in fda_cids for cid in cids}
+
+  def _resolve(self, store: KVStore, fetch: t.Callable[[list[str]], dict], keys: list[str], batch_size: int, desc: str):
+    ''' Fetch the keys missing from `store` in concurrent batches, storing each batch as it completes
+    '''
+    from tqdm import tqdm
+    from helper.utils import chunked
+    from helper.fetch import map_concurrent
+    missing = store.missing(dict.fromkeys(keys))
+    failed = 0
+    with tqdm(total=len(missing), desc=desc) as pbar:
+      for batch, values in map_concurrent(fetch, chunked(missing, batch_size), self.concurrency):
+        if isinstance(values, Exception):
+          failed += 1
+          tqdm.write(f"Failed to resolve {len(batch)} with PubChem: {values!r}")
+        else:
+          store.set_many(values)
+          store.commit()
+        pbar.update(len(batch))
+    if failed:
+      raise RuntimeError(f"{failed} batches failed to resolve with PubChem, run again to retry them")
+    return store.get_many(keys)
+
+  def fda_approved(self, drug_names: t.Iterable[str], name_batch_size=1000, cid_batch_size=100) -> dict[str, bool]:
+    ''' Whether each drug name resolves to an FDA approved compound
+    '''
+    drug_names = list(drug_names)
+    name_cids = self._resolve(self.name_cids, self.fetch_name_cids, drug_names, name_batch_size, 'Resolving drug names...')
+    cids = sorted({cid for cid in name_cids.values() if cid is not None})
+    cid_approved = self._resolve(self.cid_approved, self.fetch_fda_approvals, cids, cid_batch_size, 'Resolving FDA approvals...')
+    return {
+      drug_name: name_cids[drug_name] is not None and cid_approved[name_cids[drug_name]]
+      for drug_name in drug_names
+    }
@@ -1,7 +1,111 @@
-import psycopg2
+import io
+import os
+import threading
 import typing as t
 
+if t.TYPE_CHECKING:
+  import psycopg2
+  import pandas as pd
+  import concurrent.futures
+
 FileDescriptor = t.Union[int, str]
+T = t.TypeVar('T')
+
+def chunked(it: t.Iterable[T], n: int = 100) -> t.Iterator[list[T]]:
+  ''' Group an iterable into lists of at most `n` elements
+  '''
+  chunk = []
+  for el in it:
+    chunk.append(el)
+    if len(chunk) >= n:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+def ordered_map(
+  pool: 'concurrent.futures.Executor',
+  fn: t.Callable[[T], t.Any],
+  it: t.Iterable[T],
+  window: int,
+) -> t.Iterator:
+  ''' Like `pool.map` but with at most `window` tasks pending at once, so a large or lazy
+  iterable isn't submitted all at once, results are still yielded in order
+  '''
+  import collections
+  pending = collections.deque()
+  for el in it:
+    pending.append(pool.submit(fn, el))
+    if len(pending) >= window:
+      yield pending.popleft().result()
+  while pending:
+    yield pending.popleft().result()
+
+def peak_rss() -> int:
+  ''' The peak resident set size of this process in bytes
+  '''
+  import sys, resource
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # linux reports kilobytes, macos reports bytes
+  return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def staging_table_name(table: str):
+  ''' A unique name for a table to stage rows destined for `table` in
+  '''
+  import uuid
+  name = table.split('.')[-1].strip('"')
+  return f"{name}_staging_{uuid.uuid4().hex[:12]}"
+
+def merge_statement(
+  table: str,
+  staging: str,
+  columns: t.Iterable[str],
+  on_conflict_update: t.Optional[t.Tuple[str]] = None,
+):
+  ''' Construct the sql for inserting rows from a staging table, optionally upserting on conflict
+  '''
+  columns = list(columns)
+  statement = f'''
+    INSERT INTO {table} AS "target" ({",".join(f'"{c}"' for c in columns)})
+    SELECT {",".join(f'"{c}"' for c in columns)}
+    FROM {staging}
+  '''
+  if on_conflict_update:
+    # rows which wouldn't change are left alone, so they aren't rewritten or seen by update triggers
+    updated_columns = [c for c in columns if c not in on_conflict_update]
+    statement += f'''
+    ON CONFLICT ({",".join(f'"{c}"' for c in on_conflict_update)})
+    DO UPDATE SET {", ".join(f'"{c}" = EXCLUDED."{c}"' for c in updated_columns)}
+    WHERE ({",".join(f'"target"."{c}"' for c in updated_columns)}) IS DISTINCT FROM ({",".join(f'EXCLUDED."{c}"' for c in updated_columns)})
+    '''
+  return statement
+
+def copy_statement(
+  table: str,
+  columns: t.Iterable[str],
+  copy_options: str,
+  on_conflict_update: t.Optional[t.Tuple[str]] = None,
+):
+  ''' Construct the sql for copying into a table from stdin, optionally upserting on conflict
+  :param copy_options: The COPY options describing the format of the input
+  '''
+  columns = list(columns)
+  if on_conflict_update:
+    # rows are staged in a uniquely named, session-private temporary table with just the
+    #  copied columns & no constraints, so concurrent upserts don't collide and it isn't WAL-logged
+    staging = f'"{staging_table_name(table)}"'
+    return f'''
+    CREATE TEMP TABLE {staging} AS SELECT {",".join(f'"{c}"' for c in columns)} FROM {table} WITH NO DATA;
+    COPY {staging} ({",".join(f'"{c}"' for c in columns)})
+    FROM STDIN WITH {copy_options};
+    {merge_statement(table, staging, columns, on_conflict_update)};
+    DROP TABLE {staging};
+    '''
+  else:
+    return f'''
+    COPY {table} ({",".join(f'"{c}"' for c in columns)})
+    FROM STDIN WITH {copy_options}
+    '''
 
 def copy_from_tsv(
   conn: 'psycopg2.connection',
@@ -9,49 +113,198 @@ def copy_from_tsv(
   columns: list[str],
   r: FileDescriptor,
   on_conflict_update: t.Optional[t.Tuple[str]] = None,
+  commit: bool = True,
 ):
   ''' Copy from a file descriptor into a postgres database table through as psycopg2 connection object
   :param con: The psycopg2.connect object
   :param r: An file descriptor to be opened in read mode
   :param table: The table top copy into
   :param columns: The columns being copied
+  :param commit: Commit once copied, otherwise the copy is left to the caller's transaction
   '''
   import os
-  with conn.cursor() as cur:
-    with os.fdopen(r, 'rb', buffering=0, closefd=True) as fr:
+  # the pipe is opened first so it's closed (and the writer stops) whatever fails
+  with os.fdopen(r, 'rb', buffering=0, closefd=True) as fr:
+    with conn.cursor() as cur:
       columns = fr.readline().strip().split(b'\t')
-      if on_conflict_update:
-        cur.copy_expert(
-          sql=f'''
-          CREATE TABLE {table+'_tmp'} as table {table} WITH NO DATA;
-          COPY {table+'_tmp'} ({",".join(f'"{c.decode()}"' for c in columns)})
-          FROM STDIN WITH CSV DELIMITER E'\\t';
-          INSERT INTO {table} ({",".join(f'"{c.decode()}"' for c in columns)})
-          SELECT {",".join(f'"{c.decode()}"' for c in columns)}
-          FROM {table+'_tmp'}
-          ON CONFLICT ({",".join(f'"{c}"' for c in on_conflict_update)})
-          DO UPDATE SET {", ".join(f'"{c}" = EXCLUDED."{c}"' for c in map(bytes.decode, columns) if c not in on_conflict_update)};
-          DROP TABLE {table+'_tmp'};
-          ''',
-          file=fr,
-        )
-      else:
-        cur.copy_expert(
-          sql=f'''
-          COPY {table} ({",".join(f'"{c.decode()}"' for c in columns)})
-          FROM STDIN WITH CSV DELIMITER E'\\t'
-          ''',
-          file=fr,
-        )
+      cur.copy_expert(
+        sql=copy_statement(table, map(bytes.decode, columns), "CSV DELIMITER E'\\t'", on_conflict_update),
+        file=fr,
+      )
+  if commit:
+    conn.commit()
+
+def copy_from_binary(
+  conn: 'psycopg2.connection',
+  table: str,
+  columns: list[str],
+  r: FileDescriptor,
+  on_conflict_update: t.Optional[t.Tuple[str]] = None,
+  commit: bool = True,
+):
+  ''' Copy from a file descriptor with data in PostgreSQL's binary COPY format into a
+  postgres database table through as psycopg2 connection object
+  :param con: The psycopg2.connect object
+  :param r: An file descriptor to be opened in read mode
+  :param table: The table top copy into
+  :param columns: The columns being copied, in the order they were encoded
+  :param commit: Commit once copied, otherwise the copy is left to the caller's transaction
+  '''
+  import os
+  # the pipe is opened first so it's closed (and the writer stops) whatever fails
+  with os.fdopen(r, 'rb', closefd=True) as fr:
+    with conn.cursor() as cur:
+      cur.copy_expert(
+        sql=copy_statement(table, columns, '(FORMAT binary)', on_conflict_update),
+        file=fr,
+      )
+  if commit:
     conn.commit()
 
+def _binary_scalar_encoder(typname: str):
+  ''' Return a function encoding a python value to the binary representation of the postgres type
+  '''
+  import json, struct, uuid
+  if typname == 'uuid':
+    return lambda v: (v if isinstance(v, uuid.UUID) else uuid.UUID(str(v))).bytes
+  elif typname == 'int2':
+    return lambda v: struct.pack('!h', int(v))
+  elif typname == 'int4':
+    return lambda v: struct.pack('!i', int(v))
+  elif typname == 'int8':
+    return lambda v: struct.pack('!q', int(v))
+  elif typname == 'float4':
+    return lambda v: struct.pack('!f', float(v))
+  elif typname == 'float8':
+    return lambda v: struct.pack('!d', float(v))
+  elif typname == 'bool':
+    return lambda v: b'\x01' if v else b'\x00'
+  elif typname in ('text', 'varchar', 'bpchar', 'name', 'json'):
+    return lambda v: (v if isinstance(v, str) else json.dumps(v) if typname == 'json' else str(v)).encode()
+  elif typname == 'jsonb':
+    # jsonb is its text representation prefixed with a format version
+    return lambda v: b'\x01' + (v if isinstance(v, str) else json.dumps(v)).encode()
+  else:
+    raise NotImplementedError(f"Binary COPY of {typname} is not supported")
+
+def _binary_array_encoder(elem_oid: int, elem_typname: str):
+  ''' Return a function encoding a python list as a one dimensional postgres array
+  '''
+  import struct
+  encode_elem = _binary_scalar_encoder(elem_typname)
+  def encode(v):
+    v = list(v)
+    if not v:
+      return struct.pack('!iii', 0, 0, elem_oid)
+    elems = [None if el is None else encode_elem(el) for el in v]
+    return b''.join([
+      struct.pack('!iiiii', 1, any(el is None for el in elems), elem_oid, len(elems), 1),
+      *(
+        struct.pack('!i', -1) if el is None else struct.pack('!i', len(el)) + el
+        for el in elems
+      ),
+    ])
+  return encode
+
+def binary_encoders(
+  conn: 'psycopg2.connection',
+  table: str,
+  columns: t.Iterable[str],
+):
+  ''' Construct binary encoders for the given columns of a table based on their types in the database,
+  only the copied columns need to have a supported type
+  '''
+  columns = list(columns)
+  with conn.cursor() as cur:
+    cur.execute('''
+      select a.attname, t.typname, e.oid, e.typname
+      from pg_attribute a
+      inner join pg_type t on t.oid = a.atttypid
+      left join pg_type e on e.oid = t.typelem and t.typcategory = 'A'
+      where a.attrelid = %s::regclass and a.attnum > 0 and not a.attisdropped
+      and a.attname = any(%s)
+    ''', (table, columns))
+    column_types = {
+      attname: _binary_array_encoder(elem_oid, elem_typname) if elem_oid is not None else _binary_scalar_encoder(typname)
+      for attname, typname, elem_oid, elem_typname in cur.fetchall()
+    }
+  missing = [column for column in columns if column not in column_types]
+  if missing:
+    raise ValueError(f"{table} has no column(s) {', '.join(missing)}")
+  return [column_types[column] for column in columns]
+
+def write_binary_copy(
+  fw: t.BinaryIO,
+  columns: list[str],
+  encoders: list[t.Callable[[t.Any], bytes]],
+  records: t.Iterable[dict],
+):
+  ''' Write records in PostgreSQL's binary COPY format, None is written as NULL
+  '''
+  import struct
+  n_columns = struct.pack('!h', len(columns))
+  null = struct.pack('!i', -1)
+  # signature, flags, header extension length
+  fw.write(b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0))
+  for record in records:
+    row = [n_columns]
+    for column, encode in zip(columns, encoders):
+      value = record.get(column)
+      if value is None:
+        row.append(null)
+      else:
+        data = encode(value)
+        row.append(struct.pack('!i', len(data)))
+        row.append(data)
+    fw.write(b''.join(row))
+  # trailer
+  fw.write(struct.pack('!h', -1))
+
+class _CopyThread(threading.Thread):
+  ''' Runs a COPY from the read end of a pipe, an exception raised by the COPY is
+  re-raised by `join` so it isn't lost with the thread
+  '''
+  def __init__(self, copy_from_fd: t.Callable, args: tuple):
+    super().__init__()
+    self.copy_from_fd = copy_from_fd
+    self.copy_args = args
+    self.error = None
+  def run(self):
+    try:
+      self.copy_from_fd(*self.copy_args)
+    except BaseException as e:
+      self.error = e
+  def join(self, timeout=None):
+    super().join(timeout)
+    if self.error is not None:
+      raise self.error
+
+class _CountingPipeWriter(io.RawIOBase):
+  ''' The write end of a pipe which counts the bytes written through it
+  '''
+  def __init__(self, fd: int):
+    self.fd = fd
+    self.n_bytes = 0
+  def writable(self):
+    return True
+  def write(self, b):
+    n = os.write(self.fd, b)
+    self.n_bytes += n
+    return n
+  def close(self):
+    if not self.closed:
+      os.close(self.fd)
+    super().close()
+
 def copy_from_records(
   conn: 'psycopg2.connection',
   table: str,
   columns: list[str],
   records: t.Iterable[dict],
   on_conflict_update: t.Optional[t.Tuple[str]] = None,
-):
+  format: t.Literal['csv', 'binary'] = 'csv',
+  commit: bool = True,
+) -> int:
   ''' Copy from records into a postgres database table through as psycopg2 connection object.
   This is done by constructing a unix pipe, writing the records with csv writer
    into the pipe while loading from the pipe into postgres at the same time.
@@ -59,22 +312,137 @@ def copy_from_records(
   :param table: The table to write the pandas dataframe into
   :param columns: The columns being written into the table
   :param records: An iterable of records to write
+  :param format: `csv` or `binary`, binary encodes records in PostgreSQL's binary COPY format
+    with the column types of the table, this avoids serializing & parsing values as text.
+    Note that unlike csv, empty strings are not treated as NULL.
+  :param commit: Commit once copied, otherwise the copy is left to the caller's transaction
+  :returns: The number of bytes written into the pipe
   '''
-  import os, csv, threading
+  import io, os, csv
+  if format == 'csv':
+    copy_from_fd = copy_from_tsv
+  elif format == 'binary':
+    copy_from_fd = copy_from_binary
+    encoders = binary_encoders(conn, table, columns)
+  else:
+    raise ValueError(f"Unsupported format {format}")
   r, w = os.pipe()
   # we copy_from_tsv with the read end of this pipe in
   #  another thread
-  rt = threading.Thread(
-    target=copy_from_tsv,
-    args=(conn, table, columns, r, on_conflict_update),
-  )
+  rt = _CopyThread(copy_from_fd, (conn, table, columns, r, on_conflict_update, commit))
   rt.start()
   try:
     # we write to the write end of this pipe in this thread
-    with os.fdopen(w, 'w', closefd=True) as fw:
-      writer = csv.DictWriter(fw, fieldnames=columns, delimiter='\t')
-      writer.writeheader()
-      writer.writerows(records)
+    fw_raw = _CountingPipeWriter(w)
+    if format == 'csv':
+      with io.TextIOWrapper(io.BufferedWriter(fw_raw)) as fw:
+        writer = csv.DictWriter(fw, fieldnames=columns, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(records)
+    else:
+      with io.BufferedWriter(fw_raw) as fw:
+        write_binary_copy(fw, columns, encoders, records)
+  finally:
+    # we wait for the copy_from_tsv thread to finish, if it failed its error is raised
+    #  here, the writer will have failed with a broken pipe
+    rt.join()
+  return fw_raw.n_bytes
+
+def copy_from_records_parallel(
+  conn: 'psycopg2.connection',
+  connect: t.Callable[[], 'psycopg2.connection'],
+  table: str,
+  columns: list[str],
+  records: t.Iterable[dict],
+  on_conflict_update: t.Optional[t.Tuple[str]] = None,
+  format: t.Literal['csv', 'binary'] = 'csv',
+  n_connections: int = 4,
+  chunk_size: int = 100_000,
+):
+  ''' Like `copy_from_records` but the records are split into chunks which are copied in parallel
+  by `n_connections` connections into an unlogged staging table, and then merged into `table`
+  by `conn` in one statement. This helps with very large loads where a single COPY is bound
+  by the server parsing rows.
+  Unlike the other copy functions this manages `conn`'s transactions itself: the staging table
+  has to be visible to the other connections, so whatever is pending on `conn` is committed
+  before the copy starts and the merge is committed once done. If anything fails `conn` is
+  rolled back. The staging table isn't temporary since other connections write to it, it's an
+  unlogged `<table>_staging_<hex>` table in the schema of `table` which is dropped in any case,
+  only a process that dies mid-copy leaves it behind.
+  :param connect: Opens an additional connection to the same database
+  :param chunk_size: Records per COPY, each chunk is written by whichever connection is free
+  :returns: The number of bytes written into the pipes
+  '''
+  import queue, threading
+  schema = table.split('.')[0] if '.' in table else 'public'
+  staging = f'{schema}."{staging_table_name(table)}"'
+  with conn.cursor() as cur:
+    cur.execute(f'''
+      CREATE UNLOGGED TABLE {staging} AS
+      SELECT {",".join(f'"{c}"' for c in columns)} FROM {table} WITH NO DATA
+    ''')
+  # the staging table must be visible to the other connections
+  conn.commit()
+  try:
+    chunks = queue.Queue(maxsize=n_connections * 2)
+    n_bytes, errors = [], []
+    def worker():
+      worker_conn = None
+      try:
+        worker_conn = connect()
+        while (chunk := chunks.get()) is not None:
+          if not errors:
+            n_bytes.append(copy_from_records(worker_conn, staging, columns, chunk, format=format))
+      except Exception as e:
+        errors.append(e)
+        # keep draining so the producer never blocks
+        while chunks.get() is not None: pass
+      finally:
+        if worker_conn is not None:
+          worker_conn.close()
+    workers = [threading.Thread(target=worker) for _ in range(n_connections)]
+    for w in workers: w.start()
+    try:
+      for chunk in chunked(records, chunk_size):
+        if errors: break
+        chunks.put(chunk)
+    finally:
+      for _ in workers: chunks.put(None)
+      for w in workers: w.join()
+    if errors:
+      raise errors[0]
+    with conn.cursor() as cur:
+      cur.execute(merge_statement(table, staging, columns, on_conflict_update))
+    conn.commit()
+  finally:
+    # a failed merge leaves conn's transaction aborted, the drop is committed on its own
+    conn.rollback()
+    with conn.cursor() as cur:
+      cur.execute(f"DROP TABLE IF EXISTS {staging}")
+    conn.commit()
+  return sum(n_bytes)
+
+def copy_from_dataframe(
+  conn: 'psycopg2.connection',
+  table: str,
+  df: 'pd.DataFrame',
+  on_conflict_update: t.Optional[t.Tuple[str]] = None,
+  commit: bool = True,
+) -> int:
+  ''' Copy a pandas dataframe, with columns named after those of the table, into a postgres
+  database table through a psycopg2 connection object. Rather than building a record per row,
+  pandas' csv writer serializes the columns straight into the pipe that postgres reads from.
+  Missing values (NaN/None) are written as NULL.
+  :param commit: Commit once copied, otherwise the copy is left to the caller's transaction
+  :returns: The number of bytes written into the pipe
+  '''
+  r, w = os.pipe()
+  rt = _CopyThread(copy_from_tsv, (conn, table, list(df.columns), r, on_conflict_update, commit))
+  rt.start()
+  try:
+    fw_raw = _CountingPipeWriter(w)
+    with io.TextIOWrapper(io.BufferedWriter(fw_raw)) as fw:
+      df.to_csv(fw, sep='\t', index=False)
   finally:
-    # we wait for the copy_from_tsv thread to finish
     rt.join()
+  return fw_raw.n_bytes
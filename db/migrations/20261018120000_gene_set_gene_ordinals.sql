@@ -0,0 +1,139 @@
+-- migrate:up
+
+-- a dense integer key for genes, gene sets store an array of these rather than
+--  repeating the 36 character uuid of every gene in a jsonb object
+alter table app_public_v2.gene add column ordinal int generated by default as identity;
+alter table app_public_v2.gene add constraint gene_ordinal_key unique (ordinal);
+
+-- the genes of the gene set in order
+alter table app_public_v2.gene_set add column gene_ordinals int4[];
+
+update app_public_v2.gene_set gs
+set gene_ordinals = (
+  select coalesce(array_agg(g.ordinal order by gsg.position::int), '{}'::int4[])
+  from jsonb_each_text(gs.gene_ids) gsg(gene_id, position)
+  inner join app_public_v2.gene g on g.id = gsg.gene_id::uuid
+);
+
+alter table app_public_v2.gene_set alter column gene_ordinals set not null;
+create index gene_set_gene_ordinals_idx on app_public_v2.gene_set using gin (gene_ordinals);
+
+create or replace function app_public_v2.gene_set_genes(gene_set app_public_v2.gene_set)
+returns setof app_public_v2.gene as
+$$
+  select g.*
+  from unnest(gene_set_genes.gene_set.gene_ordinals) with ordinality gsg(ordinal, position)
+  inner join app_public_v2.gene g on gsg.ordinal = g.ordinal
+  order by gsg.position asc;
+$$ language sql immutable strict parallel safe;
+grant execute on function app_public_v2.gene_set_genes to guest, authenticated;
+
+create or replace function app_public_v2.gene_set_overlap(
+  gene_set app_public_v2.gene_set,
+  genes varchar[]
+) returns setof app_public_v2.gene
+as $$
+  select distinct g.*
+  from app_public_v2.gene_map(gene_set_overlap.genes) gm
+  inner join app_public_v2.gene g on g.id = gm.gene_id
+  where g.ordinal = any(gene_set.gene_ordinals);
+$$ language sql immutable strict;
+grant execute on function app_public_v2.gene_set_overlap to guest, authenticated;
+
+create or replace function app_public_v2.gene_set_gene_search(genes varchar[]) returns setof app_public_v2.gene_set
+as $$
+  select distinct gs.*
+  from
+    app_public_v2.gene_map(genes) gm
+    inner join app_public_v2.gene g on g.id = gm.gene_id
+    inner join app_public_v2.gene_set gs on gs.gene_ordinals @> array[g.ordinal];
+$$ language sql immutable strict parallel safe;
+grant execute on function app_public_v2.gene_set_gene_search to guest, authenticated;
+
+create or replace function app_public_v2.background_overlap(
+  background app_public_v2.background,
+  genes varchar[],
+  overlap_greater_than int default 0
+) returns table (
+  gene_set_id uuid,
+  n_overlap_gene_ids int,
+  n_gs_gene_ids int
+)
+as $$
+  select
+    gs.id as gene_set_id,
+    count(ig.ordinal) as n_overlap_gene_ids,
+    gs.n_gene_ids as n_gs_gene_ids
+  from
+    (
+      select distinct g.ordinal
+      from app_public_v2.gene_map(background_overlap.genes) gm
+      inner join app_public_v2.gene g on g.id = gm.gene_id
+    ) ig
+    inner join app_public_v2.gene_set gs on gs.gene_ordinals @> array[ig.ordinal]
+  group by gs.id
+  having count(ig.ordinal) > background_overlap.overlap_greater_than;
+$$ language sql immutable strict;
+grant execute on function app_public_v2.background_overlap to guest, authenticated;
+
+-- migrate:down
+
+create or replace function app_public_v2.background_overlap(
+  background app_public_v2.background,
+  genes varchar[],
+  overlap_greater_than int default 0
+) returns table (
+  gene_set_id uuid,
+  n_overlap_gene_ids int,
+  n_gs_gene_ids int
+)
+as $$
+  select
+    gs.id as gene_set_id,
+    count(ig.gene_id) as n_overlap_gene_ids,
+    gs.n_gene_ids as n_gs_gene_ids
+  from
+    (
+      select distinct g.gene_id::text
+      from app_public_v2.gene_map(background_overlap.genes) g
+    ) ig
+    inner join app_public_v2.gene_set gs on gs.gene_ids ? ig.gene_id
+  group by gs.id
+  having count(ig.gene_id) > background_overlap.overlap_greater_than;
+$$ language sql immutable strict;
+grant execute on function app_public_v2.background_overlap to guest, authenticated;
+
+create or replace function app_public_v2.gene_set_gene_search(genes varchar[]) returns setof app_public_v2.gene_set
+as $$
+  select distinct gs.*
+  from
+    app_public_v2.gene_map(genes) g
+    inner join app_public_v2.gene_set gs on gs.gene_ids ? g.gene_id::text;
+$$ language sql immutable strict parallel safe;
+grant execute on function app_public_v2.gene_set_gene_search to guest, authenticated;
+
+create or replace function app_public_v2.gene_set_overlap(
+  gene_set app_public_v2.gene_set,
+  genes varchar[]
+) returns setof app_public_v2.gene
+as $$
+  select distinct g.*
+  from app_public_v2.gene_map(gene_set_overlap.genes) gm
+  inner join app_public_v2.gene g on g.id = gm.gene_id
+  where gene_set.gene_ids ? gm.gene_id::text;
+$$ language sql immutable strict;
+grant execute on function app_public_v2.gene_set_overlap to guest, authenticated;
+
+create or replace function app_public_v2.gene_set_genes(gene_set app_public_v2.gene_set)
+returns setof app_public_v2.gene as
+$$
+  select g.*
+  from jsonb_each(gene_set_genes.gene_set.gene_ids) gsg(gene_id, position)
+  inner join app_public_v2.gene g on gsg.gene_id = g.id::text
+  order by gsg.position asc;
+$$ language sql immutable strict parallel safe;
+grant execute on function app_public_v2.gene_set_genes to guest, authenticated;
+
+drop index app_public_v2.gene_set_gene_ordinals_idx;
+alter table app_public_v2.gene_set drop column gene_ordinals;
+alter table app_public_v2.gene drop column ordinal;
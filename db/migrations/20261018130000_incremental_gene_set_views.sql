@@ -0,0 +1,232 @@
+-- migrate:up
+
+-- gene_set_pmc & gene_set_fda_counts were materialized views which had to be
+--  refreshed in full after every ingest, they're now tables maintained by
+--  statement level triggers from only the rows which changed
+
+create or replace function app_private_v2.gene_set_term_pmc(term varchar) returns text
+as $$
+  select regexp_replace(term, '^(^PMC\d+)(.*)$', '\1');
+$$ language sql immutable strict parallel safe;
+
+create or replace function app_private_v2.gene_set_term_perturbation(term varchar) returns text
+as $$
+  select replace(replace(split_part(term, '_', 5), ' up', ' '), ' down', ' ');
+$$ language sql immutable strict parallel safe;
+
+-- used to find the gene sets of a perturbation when fda_counts change
+create index gene_set_perturbation_idx on app_public_v2.gene_set (app_private_v2.gene_set_term_perturbation(term));
+
+drop view app_public_v2.pmc;
+drop materialized view app_public_v2.gene_set_pmc;
+
+create table app_public_v2.gene_set_pmc (
+  id uuid not null,
+  pmc text not null
+);
+insert into app_public_v2.gene_set_pmc (id, pmc)
+select gs.id, app_private_v2.gene_set_term_pmc(gs.term)
+from app_public_v2.gene_set gs;
+comment on table app_public_v2.gene_set_pmc is E'@foreignKey (id) references app_public_v2.gene_set (id)';
+
+create unique index gene_set_pmc_id_pmc_idx on app_public_v2.gene_set_pmc (id, pmc);
+create index gene_set_pmc_id_idx on app_public_v2.gene_set_pmc (id);
+create index gene_set_pmc_pmc_idx on app_public_v2.gene_set_pmc (pmc);
+
+grant select on app_public_v2.gene_set_pmc to guest;
+grant all privileges on app_public_v2.gene_set_pmc to authenticated;
+
+create view app_public_v2.pmc as select distinct pmc from app_public_v2.gene_set_pmc;
+comment on view app_public_v2.pmc is E'@foreignKey (pmc) references app_public_v2.gene_set_pmc (pmc)';
+
+grant select on app_public_v2.pmc to guest;
+grant all privileges on app_public_v2.pmc to authenticated;
+
+drop materialized view app_public_v2.gene_set_fda_counts cascade;
+
+create table app_public_v2.gene_set_fda_counts (
+  id uuid not null,
+  perturbation varchar not null,
+  count int,
+  approved boolean,
+  moa text
+);
+insert into app_public_v2.gene_set_fda_counts (id, perturbation, count, approved, moa)
+select gs.id, fda.perturbation, fda.count, fda.approved, fda.moa
+from app_public_v2.gene_set gs
+inner join app_public_v2.fda_counts fda
+on app_private_v2.gene_set_term_perturbation(gs.term) = fda.perturbation;
+comment on table app_public_v2.gene_set_fda_counts is E'@foreignKey (id) references app_public_v2.gene_set (id)';
+
+create index gene_set_fda_counts_id_idx on app_public_v2.gene_set_fda_counts (id);
+create index gene_set_fda_counts_perturbation_idx on app_public_v2.gene_set_fda_counts (perturbation);
+
+grant select on app_public_v2.gene_set_fda_counts to guest;
+grant all privileges on app_public_v2.gene_set_fda_counts to authenticated;
+
+create or replace function app_public_v2.get_fda_counts_by_id(id uuid)
+returns setof app_public_v2.gene_set_fda_counts as
+$$
+select * from app_public_v2.gene_set_fda_counts where id = $1
+$$ language sql immutable strict parallel safe;
+
+grant execute on function app_public_v2.get_fda_counts_by_id to guest, authenticated;
+
+create or replace function app_private_v2.gene_set_maintain_views() returns trigger
+as $$
+begin
+  if TG_OP in ('UPDATE', 'DELETE') then
+    delete from app_public_v2.gene_set_pmc gsp
+    where gsp.id in (select ogs.id from old_gene_set ogs);
+    delete from app_public_v2.gene_set_fda_counts gsfc
+    where gsfc.id in (select ogs.id from old_gene_set ogs);
+  end if;
+  if TG_OP in ('INSERT', 'UPDATE') then
+    insert into app_public_v2.gene_set_pmc (id, pmc)
+    select ngs.id, app_private_v2.gene_set_term_pmc(ngs.term)
+    from new_gene_set ngs;
+    insert into app_public_v2.gene_set_fda_counts (id, perturbation, count, approved, moa)
+    select ngs.id, fda.perturbation, fda.count, fda.approved, fda.moa
+    from new_gene_set ngs
+    inner join app_public_v2.fda_counts fda
+    on app_private_v2.gene_set_term_perturbation(ngs.term) = fda.perturbation;
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger gene_set_maintain_views_insert
+after insert on app_public_v2.gene_set
+referencing new table as new_gene_set
+for each statement execute function app_private_v2.gene_set_maintain_views();
+
+create trigger gene_set_maintain_views_update
+after update on app_public_v2.gene_set
+referencing old table as old_gene_set new table as new_gene_set
+for each statement execute function app_private_v2.gene_set_maintain_views();
+
+create trigger gene_set_maintain_views_delete
+after delete on app_public_v2.gene_set
+referencing old table as old_gene_set
+for each statement execute function app_private_v2.gene_set_maintain_views();
+
+create or replace function app_private_v2.fda_counts_maintain_views() returns trigger
+as $$
+begin
+  if TG_OP in ('UPDATE', 'DELETE') then
+    delete from app_public_v2.gene_set_fda_counts gsfc
+    where gsfc.perturbation in (select ofda.perturbation from old_fda_counts ofda);
+  end if;
+  if TG_OP in ('INSERT', 'UPDATE') then
+    insert into app_public_v2.gene_set_fda_counts (id, perturbation, count, approved, moa)
+    select gs.id, nfda.perturbation, nfda.count, nfda.approved, nfda.moa
+    from new_fda_counts nfda
+    inner join app_public_v2.gene_set gs
+    on app_private_v2.gene_set_term_perturbation(gs.term) = nfda.perturbation;
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger fda_counts_maintain_views_insert
+after insert on app_public_v2.fda_counts
+referencing new table as new_fda_counts
+for each statement execute function app_private_v2.fda_counts_maintain_views();
+
+create trigger fda_counts_maintain_views_update
+after update on app_public_v2.fda_counts
+referencing old table as old_fda_counts new table as new_fda_counts
+for each statement execute function app_private_v2.fda_counts_maintain_views();
+
+create trigger fda_counts_maintain_views_delete
+after delete on app_public_v2.fda_counts
+referencing old table as old_fda_counts
+for each statement execute function app_private_v2.fda_counts_maintain_views();
+
+create or replace function app_private_v2.gene_set_truncate_views() returns trigger
+as $$
+begin
+  truncate app_public_v2.gene_set_pmc;
+  truncate app_public_v2.gene_set_fda_counts;
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger gene_set_truncate_views
+after truncate on app_public_v2.gene_set
+for each statement execute function app_private_v2.gene_set_truncate_views();
+
+create or replace function app_private_v2.fda_counts_truncate_views() returns trigger
+as $$
+begin
+  truncate app_public_v2.gene_set_fda_counts;
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger fda_counts_truncate_views
+after truncate on app_public_v2.fda_counts
+for each statement execute function app_private_v2.fda_counts_truncate_views();
+
+-- migrate:down
+
+drop trigger fda_counts_truncate_views on app_public_v2.fda_counts;
+drop function app_private_v2.fda_counts_truncate_views;
+drop trigger gene_set_truncate_views on app_public_v2.gene_set;
+drop function app_private_v2.gene_set_truncate_views;
+drop trigger fda_counts_maintain_views_delete on app_public_v2.fda_counts;
+drop trigger fda_counts_maintain_views_update on app_public_v2.fda_counts;
+drop trigger fda_counts_maintain_views_insert on app_public_v2.fda_counts;
+drop function app_private_v2.fda_counts_maintain_views;
+drop trigger gene_set_maintain_views_delete on app_public_v2.gene_set;
+drop trigger gene_set_maintain_views_update on app_public_v2.gene_set;
+drop trigger gene_set_maintain_views_insert on app_public_v2.gene_set;
+drop function app_private_v2.gene_set_maintain_views;
+
+drop table app_public_v2.gene_set_fda_counts cascade;
+
+create materialized view app_public_v2.gene_set_fda_counts as
+select gs.id, fda.perturbation, fda.count, fda.approved, fda.moa
+from app_public_v2.gene_set gs
+inner join app_public_v2.fda_counts fda
+on replace(replace(split_part(gs.term, '_', 5), ' up', ' '), ' down', ' ') = fda.perturbation;
+
+create index gene_set_fda_counts_id_idx on app_public_v2.gene_set_fda_counts (id);
+
+grant select on app_public_v2.gene_set_fda_counts to guest;
+grant all privileges on app_public_v2.gene_set_fda_counts to authenticated;
+
+comment on materialized view app_public_v2.gene_set_fda_counts is E'@foreignKey (id) references app_public_v2.gene_set (id)';
+
+create or replace function app_public_v2.get_fda_counts_by_id(id uuid)
+returns setof app_public_v2.gene_set_fda_counts as
+$$
+select * from app_public_v2.gene_set_fda_counts where id = $1
+$$ language sql immutable strict parallel safe;
+
+grant execute on function app_public_v2.get_fda_counts_by_id to guest, authenticated;
+
+drop view app_public_v2.pmc;
+drop table app_public_v2.gene_set_pmc;
+
+create materialized view app_public_v2.gene_set_pmc as
+select gs.id, regexp_replace(gs.term, '^(^PMC\d+)(.*)$', '\1') as pmc
+from app_public_v2.gene_set gs;
+comment on materialized view app_public_v2.gene_set_pmc is E'@foreignKey (id) references app_public_v2.gene_set (id)';
+
+create unique index gene_set_pmc_id_pmc_idx on app_public_v2.gene_set_pmc (id, pmc);
+create index gene_set_pmc_id_idx on app_public_v2.gene_set_pmc (id);
+create index gene_set_pmc_pmc_idx on app_public_v2.gene_set_pmc (pmc);
+
+grant select on app_public_v2.gene_set_pmc to guest;
+grant all privileges on app_public_v2.gene_set_pmc to authenticated;
+
+create view app_public_v2.pmc as select distinct pmc from app_public_v2.gene_set_pmc;
+comment on view app_public_v2.pmc is E'@foreignKey (pmc) references app_public_v2.gene_set_pmc (pmc)';
+
+grant select on app_public_v2.pmc to guest;
+grant all privileges on app_public_v2.pmc to authenticated;
+
+drop index app_public_v2.gene_set_perturbation_idx;
+drop function app_private_v2.gene_set_term_perturbation;
+drop function app_private_v2.gene_set_term_pmc;
@@ -0,0 +1,17 @@
+-- migrate:up
+
+-- progress of resumable loads by the bot, a source (file) is identified by
+--  its path and the hash of its content so a changed file starts over
+create table app_private_v2.ingest_checkpoint (
+  source varchar not null,
+  content_hash varchar not null,
+  byte_offset bigint not null default 0,
+  n_records bigint not null default 0,
+  completed boolean not null default false,
+  updated timestamp not null default now(),
+  primary key (source, content_hash)
+);
+
+-- migrate:down
+
+drop table app_private_v2.ingest_checkpoint;
@@ -0,0 +1,68 @@
+-- migrate:up
+
+-- a version stamp of the symbol -> gene mapping, clients caching gene_map results
+--  compare it to know if their cache is still valid. The epoch identifies the
+--  database, the version is bumped by any statement which changes gene_map
+create table app_private_v2.gene_version (
+  epoch uuid not null default uuid_generate_v4(),
+  version bigint not null default 0,
+  -- there is only ever one row
+  singleton boolean primary key default true check (singleton)
+);
+insert into app_private_v2.gene_version default values;
+
+create or replace function app_private_v2.gene_version_bump() returns trigger
+as $$
+declare
+  changed boolean;
+begin
+  -- statement triggers also fire when no rows were affected, and an update (like
+  --  ingest-gene-info's upsert of descriptions) only matters if the mapped columns changed.
+  --  Each transition table is only referenced in the branch of the events which have it.
+  if TG_OP = 'TRUNCATE' then
+    changed := true;
+  elsif TG_OP = 'INSERT' then
+    changed := exists (select from new_gene);
+  elsif TG_OP = 'DELETE' then
+    changed := exists (select from old_gene);
+  else
+    changed := exists (
+      (select id, symbol, synonyms, ordinal from new_gene except all select id, symbol, synonyms, ordinal from old_gene)
+      union all
+      (select id, symbol, synonyms, ordinal from old_gene except all select id, symbol, synonyms, ordinal from new_gene)
+    );
+  end if;
+  if changed then
+    update app_private_v2.gene_version set version = version + 1;
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger gene_version_bump_insert
+after insert on app_public_v2.gene
+referencing new table as new_gene
+for each statement execute function app_private_v2.gene_version_bump();
+
+create trigger gene_version_bump_update
+after update on app_public_v2.gene
+referencing old table as old_gene new table as new_gene
+for each statement execute function app_private_v2.gene_version_bump();
+
+create trigger gene_version_bump_delete
+after delete on app_public_v2.gene
+referencing old table as old_gene
+for each statement execute function app_private_v2.gene_version_bump();
+
+create trigger gene_version_bump_truncate
+after truncate on app_public_v2.gene
+for each statement execute function app_private_v2.gene_version_bump();
+
+-- migrate:down
+
+drop trigger gene_version_bump_truncate on app_public_v2.gene;
+drop trigger gene_version_bump_delete on app_public_v2.gene;
+drop trigger gene_version_bump_update on app_public_v2.gene;
+drop trigger gene_version_bump_insert on app_public_v2.gene;
+drop function app_private_v2.gene_version_bump;
+drop table app_private_v2.gene_version;
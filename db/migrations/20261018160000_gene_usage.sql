@@ -0,0 +1,160 @@
+-- migrate:up
+
+-- the number of gene sets referencing each gene, maintained by statement level
+--  triggers on gene_set so a background (the set of genes used by any gene set)
+--  can be created without expanding every gene set.
+create sequence app_private_v2.gene_usage_since_seq;
+
+create table app_private_v2.gene_usage (
+  ordinal int4 primary key,
+  n_gene_sets int not null check (n_gene_sets > 0),
+  -- increases whenever a gene becomes referenced, genes referenced after a background
+  --  was created are exactly those with since > that background's since
+  since bigint not null default nextval('app_private_v2.gene_usage_since_seq')
+);
+insert into app_private_v2.gene_usage (ordinal, n_gene_sets)
+select gsg.ordinal, count(distinct gs.id)
+from app_public_v2.gene_set gs, unnest(gs.gene_ordinals) gsg(ordinal)
+group by gsg.ordinal
+order by gsg.ordinal;
+create index gene_usage_since_idx on app_private_v2.gene_usage (since);
+
+-- the gene_usage a background was created from
+create table app_private_v2.background_gene_usage (
+  background_id uuid primary key references app_public_v2.background (id) on delete cascade,
+  since bigint not null
+);
+
+create or replace function app_private_v2.gene_set_maintain_gene_usage() returns trigger
+as $$
+begin
+  if TG_OP in ('UPDATE', 'DELETE') then
+    -- genes no longer referenced are removed, the rest are decremented
+    delete from app_private_v2.gene_usage gu
+    using (
+      select gsg.ordinal, count(distinct ogs.id) as n_gene_sets
+      from old_gene_set ogs, unnest(ogs.gene_ordinals) gsg(ordinal)
+      group by gsg.ordinal
+    ) ogu
+    where gu.ordinal = ogu.ordinal
+    and gu.n_gene_sets <= ogu.n_gene_sets;
+    update app_private_v2.gene_usage gu
+    set n_gene_sets = gu.n_gene_sets - ogu.n_gene_sets
+    from (
+      select gsg.ordinal, count(distinct ogs.id) as n_gene_sets
+      from old_gene_set ogs, unnest(ogs.gene_ordinals) gsg(ordinal)
+      group by gsg.ordinal
+    ) ogu
+    where gu.ordinal = ogu.ordinal;
+  end if;
+  if TG_OP in ('INSERT', 'UPDATE') then
+    -- rows are locked in ordinal order so concurrent ingests don't deadlock
+    insert into app_private_v2.gene_usage (ordinal, n_gene_sets)
+    select gsg.ordinal, count(distinct ngs.id)
+    from new_gene_set ngs, unnest(ngs.gene_ordinals) gsg(ordinal)
+    group by gsg.ordinal
+    order by gsg.ordinal
+    on conflict (ordinal) do update
+    set n_gene_sets = app_private_v2.gene_usage.n_gene_sets + excluded.n_gene_sets;
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger gene_set_maintain_gene_usage_insert
+after insert on app_public_v2.gene_set
+referencing new table as new_gene_set
+for each statement execute function app_private_v2.gene_set_maintain_gene_usage();
+
+-- transition tables can't be combined with a column list, so any update recounts its gene
+--  sets, the decrement & increment cancel out when gene_ordinals didn't change
+create trigger gene_set_maintain_gene_usage_update
+after update on app_public_v2.gene_set
+referencing old table as old_gene_set new table as new_gene_set
+for each statement execute function app_private_v2.gene_set_maintain_gene_usage();
+
+create trigger gene_set_maintain_gene_usage_delete
+after delete on app_public_v2.gene_set
+referencing old table as old_gene_set
+for each statement execute function app_private_v2.gene_set_maintain_gene_usage();
+
+create or replace function app_private_v2.gene_set_truncate_gene_usage() returns trigger
+as $$
+begin
+  truncate app_private_v2.gene_usage;
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger gene_set_truncate_gene_usage
+after truncate on app_public_v2.gene_set
+for each statement execute function app_private_v2.gene_set_truncate_gene_usage();
+
+-- a new background with every gene currently referenced by a gene set
+create or replace function app_private_v2.create_background() returns app_public_v2.background
+as $$
+declare
+  new_background app_public_v2.background;
+begin
+  insert into app_public_v2.background (gene_ids, n_gene_ids)
+  select
+    coalesce(jsonb_object_agg(g.id, null), '{}'::jsonb) as gene_ids,
+    count(g.id) as n_gene_ids
+  from app_private_v2.gene_usage gu
+  inner join app_public_v2.gene g on g.ordinal = gu.ordinal
+  returning * into new_background;
+  insert into app_private_v2.background_gene_usage (background_id, since)
+  select new_background.id, coalesce(max(gu.since), 0)
+  from app_private_v2.gene_usage gu;
+  return new_background;
+end;
+$$ language plpgsql;
+
+-- a new background with the genes of `base` and every gene which became referenced since
+--  `base` was created. Genes which are no longer referenced are kept, so this only
+--  suits additive ingests, `create_background` gives the exact set.
+create or replace function app_private_v2.create_background_from(base uuid) returns app_public_v2.background
+as $$
+declare
+  base_since bigint;
+  new_background app_public_v2.background;
+begin
+  select bgu.since into base_since
+  from app_private_v2.background_gene_usage bgu
+  where bgu.background_id = base;
+  if base_since is null then
+    raise exception 'background % was not created from gene_usage', base;
+  end if;
+  insert into app_public_v2.background (gene_ids, n_gene_ids)
+  select gene_ids, (select count(*) from jsonb_object_keys(gene_ids))
+  from (
+    select b.gene_ids || coalesce((
+      select jsonb_object_agg(g.id, null)
+      from app_private_v2.gene_usage gu
+      inner join app_public_v2.gene g on g.ordinal = gu.ordinal
+      where gu.since > base_since
+    ), '{}'::jsonb) as gene_ids
+    from app_public_v2.background b
+    where b.id = base
+  ) b
+  returning * into new_background;
+  insert into app_private_v2.background_gene_usage (background_id, since)
+  select new_background.id, greatest(base_since, coalesce(max(gu.since), 0))
+  from app_private_v2.gene_usage gu;
+  return new_background;
+end;
+$$ language plpgsql;
+
+-- migrate:down
+
+drop function app_private_v2.create_background_from;
+drop function app_private_v2.create_background;
+drop trigger gene_set_truncate_gene_usage on app_public_v2.gene_set;
+drop function app_private_v2.gene_set_truncate_gene_usage;
+drop trigger gene_set_maintain_gene_usage_delete on app_public_v2.gene_set;
+drop trigger gene_set_maintain_gene_usage_update on app_public_v2.gene_set;
+drop trigger gene_set_maintain_gene_usage_insert on app_public_v2.gene_set;
+drop function app_private_v2.gene_set_maintain_gene_usage;
+drop table app_private_v2.background_gene_usage;
+drop table app_private_v2.gene_usage;
+drop sequence app_private_v2.gene_usage_since_seq;
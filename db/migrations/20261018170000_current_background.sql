@@ -0,0 +1,40 @@
+-- migrate:up
+
+-- the background queries should use, it's switched by update-background once the
+--  enrich index of a new background is ready so that queries never wait on a build
+create table app_private_v2.current_background (
+  background_id uuid not null references app_public_v2.background (id) on delete cascade,
+  -- there is only ever one row
+  singleton boolean primary key default true check (singleton)
+);
+
+-- falls back to the oldest background if none was selected, it's stable rather than
+--  immutable since the result changes when the current background is switched
+create or replace function app_public_v2.current_background() returns app_public_v2.background
+as $$
+  select b.*
+  from app_public_v2.background b
+  left join app_private_v2.current_background cb on cb.background_id = b.id
+  order by cb.background_id is null, b.created asc
+  limit 1;
+$$ language sql strict stable parallel safe security definer;
+
+create or replace function app_private_v2.set_current_background(background_id uuid) returns void
+as $$
+  insert into app_private_v2.current_background (background_id)
+  values (set_current_background.background_id)
+  on conflict (singleton) do update
+  set background_id = excluded.background_id;
+$$ language sql strict;
+
+-- migrate:down
+
+drop function app_private_v2.set_current_background;
+create or replace function app_public_v2.current_background() returns app_public_v2.background
+as $$
+  select *
+  from app_public_v2.background
+  order by created asc
+  limit 1;
+$$ language sql strict immutable parallel safe security definer;
+drop table app_private_v2.current_background;
@@ -0,0 +1,555 @@
+-- migrate:up
+
+-- enrichment results are cached by background, the mapped gene ids & the query parameters
+--  other than the page, so paging through a result or repeating a query doesn't go to the
+--  enrich service again. The full (unpaged) result is stored, entries are evicted least
+--  recently used first once a cache grows beyond `app.enrich_cache_max_bytes` (512MB by
+--  default) and are removed along with their background.
+-- Sort orders are cached as separate entries since the enrich service's orderings can't be
+--  reproduced exactly here. Results are stored as the paginated result types, a migration
+--  which changes those types should recreate the caches.
+-- The caching functions write, so they're volatile & parallel unsafe. postgraphile only
+--  exposes stable functions as computed columns, so background.enrich & pairedEnrich are
+--  stable wrappers around them.
+
+create or replace function app_private_v2.enrich_cache_max_bytes() returns bigint
+as $$
+  select coalesce(nullif(current_setting('app.enrich_cache_max_bytes', true), '')::bigint, 512 * 1024 * 1024);
+$$ language sql stable;
+
+-- gene ids normalized for the cache key, order & duplicates don't change the result
+create or replace function app_private_v2.enrich_cache_gene_ids(gene_ids uuid[]) returns text
+as $$
+  select string_agg(distinct g::text, ',' order by g::text) from unnest(gene_ids) g;
+$$ language sql immutable strict parallel safe;
+
+create or replace function app_private_v2.enrich_cache_key(background_id uuid, gene_ids text[], params jsonb) returns uuid
+as $$
+  select md5(jsonb_build_array(background_id, gene_ids, params)::text)::uuid;
+$$ language sql immutable parallel safe;
+
+-- the total size of each cache, maintained by triggers so eviction doesn't need to sum the cache
+create table app_private_v2.enrich_cache_size (
+  cache regclass primary key,
+  n_bytes bigint not null default 0
+);
+
+create or replace function app_private_v2.enrich_cache_maintain_size() returns trigger
+as $$
+begin
+  -- each transition table is only referenced in the branch of the event which has it
+  if TG_OP = 'INSERT' then
+    update app_private_v2.enrich_cache_size s
+    set n_bytes = s.n_bytes + (select coalesce(sum(nc.n_bytes), 0) from new_cache nc)
+    where s.cache = TG_RELID::regclass;
+  elsif TG_OP = 'DELETE' then
+    update app_private_v2.enrich_cache_size s
+    set n_bytes = s.n_bytes - (select coalesce(sum(oc.n_bytes), 0) from old_cache oc)
+    where s.cache = TG_RELID::regclass;
+  else
+    update app_private_v2.enrich_cache_size s
+    set n_bytes = 0
+    where s.cache = TG_RELID::regclass;
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+create table app_private_v2.enrich_cache (
+  key uuid primary key,
+  background_id uuid not null references app_public_v2.background (id) on delete cascade,
+  result app_public_v2.paginated_enrich_result not null,
+  n_bytes int not null,
+  last_used timestamptz not null default now()
+);
+create index enrich_cache_background_id_idx on app_private_v2.enrich_cache (background_id);
+create index enrich_cache_last_used_idx on app_private_v2.enrich_cache (last_used);
+create trigger enrich_cache_maintain_size_insert
+after insert on app_private_v2.enrich_cache
+referencing new table as new_cache
+for each statement execute function app_private_v2.enrich_cache_maintain_size();
+create trigger enrich_cache_maintain_size_delete
+after delete on app_private_v2.enrich_cache
+referencing old table as old_cache
+for each statement execute function app_private_v2.enrich_cache_maintain_size();
+create trigger enrich_cache_maintain_size_truncate
+after truncate on app_private_v2.enrich_cache
+for each statement execute function app_private_v2.enrich_cache_maintain_size();
+insert into app_private_v2.enrich_cache_size (cache) values ('app_private_v2.enrich_cache'::regclass);
+
+create or replace function app_private_v2.enrich_cache_put(key uuid, background_id uuid, result app_public_v2.paginated_enrich_result) returns void
+as $$
+declare
+  excess bigint;
+  lru record;
+begin
+  insert into app_private_v2.enrich_cache (key, background_id, result, n_bytes)
+  values (enrich_cache_put.key, enrich_cache_put.background_id, enrich_cache_put.result, pg_column_size(enrich_cache_put.result))
+  on conflict do nothing;
+  -- evict the least recently used results until the cache is back within the size limit,
+  --  the loop walks last_used's index so only the evicted results are read
+  select s.n_bytes - app_private_v2.enrich_cache_max_bytes() into excess
+  from app_private_v2.enrich_cache_size s
+  where s.cache = 'app_private_v2.enrich_cache'::regclass;
+  if excess > 0 then
+    for lru in
+      select c.key, c.n_bytes
+      from app_private_v2.enrich_cache c
+      order by c.last_used
+    loop
+      delete from app_private_v2.enrich_cache c where c.key = lru.key;
+      excess := excess - lru.n_bytes;
+      exit when excess <= 0;
+    end loop;
+  end if;
+end;
+$$ language plpgsql volatile;
+
+create table app_private_v2.paired_enrich_cache (
+  key uuid primary key,
+  background_id uuid not null references app_public_v2.background (id) on delete cascade,
+  result app_public_v2.paginated_paired_enrich_result not null,
+  n_bytes int not null,
+  last_used timestamptz not null default now()
+);
+create index paired_enrich_cache_background_id_idx on app_private_v2.paired_enrich_cache (background_id);
+create index paired_enrich_cache_last_used_idx on app_private_v2.paired_enrich_cache (last_used);
+create trigger paired_enrich_cache_maintain_size_insert
+after insert on app_private_v2.paired_enrich_cache
+referencing new table as new_cache
+for each statement execute function app_private_v2.enrich_cache_maintain_size();
+create trigger paired_enrich_cache_maintain_size_delete
+after delete on app_private_v2.paired_enrich_cache
+referencing old table as old_cache
+for each statement execute function app_private_v2.enrich_cache_maintain_size();
+create trigger paired_enrich_cache_maintain_size_truncate
+after truncate on app_private_v2.paired_enrich_cache
+for each statement execute function app_private_v2.enrich_cache_maintain_size();
+insert into app_private_v2.enrich_cache_size (cache) values ('app_private_v2.paired_enrich_cache'::regclass);
+
+create or replace function app_private_v2.paired_enrich_cache_put(key uuid, background_id uuid, result app_public_v2.paginated_paired_enrich_result) returns void
+as $$
+declare
+  excess bigint;
+  lru record;
+begin
+  insert into app_private_v2.paired_enrich_cache (key, background_id, result, n_bytes)
+  values (paired_enrich_cache_put.key, paired_enrich_cache_put.background_id, paired_enrich_cache_put.result, pg_column_size(paired_enrich_cache_put.result))
+  on conflict do nothing;
+  -- evict the least recently used results until the cache is back within the size limit,
+  --  the loop walks last_used's index so only the evicted results are read
+  select s.n_bytes - app_private_v2.enrich_cache_max_bytes() into excess
+  from app_private_v2.enrich_cache_size s
+  where s.cache = 'app_private_v2.paired_enrich_cache'::regclass;
+  if excess > 0 then
+    for lru in
+      select c.key, c.n_bytes
+      from app_private_v2.paired_enrich_cache c
+      order by c.last_used
+    loop
+      delete from app_private_v2.paired_enrich_cache c where c.key = lru.key;
+      excess := excess - lru.n_bytes;
+      exit when excess <= 0;
+    end loop;
+  end if;
+end;
+$$ language plpgsql volatile;
+
+-- only touched at most once a minute so repeated hits don't each write
+create or replace function app_private_v2.enrich_cache_touch(cache regclass, key uuid) returns void
+as $$
+begin
+  execute format('update %s set last_used = now() where key = $1 and last_used < now() - interval ''1 minute''', cache)
+  using key;
+end;
+$$ language plpgsql volatile;
+
+create or replace function app_private_v2.enrich_cache_invalidate() returns trigger
+as $$
+begin
+  delete from app_private_v2.enrich_cache c where c.background_id in (select nb.id from new_background nb);
+  delete from app_private_v2.paired_enrich_cache c where c.background_id in (select nb.id from new_background nb);
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger enrich_cache_invalidate
+after update on app_public_v2.background
+referencing new table as new_background
+for each statement execute function app_private_v2.enrich_cache_invalidate();
+
+create or replace function app_private_v2.background_enrich(
+  background app_public_v2.background,
+  genes varchar[],
+  filter_term varchar default null,
+  overlap_ge int default 1,
+  pvalue_le double precision default 0.05,
+  adj_pvalue_le double precision default 0.05,
+  "offset" int default null,
+  "first" int default null,
+  filter_fda boolean default false,
+  sortby varchar default null,
+  filter_ko boolean default false,
+  top_n int default 10000
+) returns app_public_v2.paginated_enrich_result
+as $$
+declare
+  start timestamptz := clock_timestamp();
+  gene_ids uuid[];
+  cache_key uuid;
+  page_start int := coalesce(background_enrich."offset", 0);
+  result app_public_v2.paginated_enrich_result;
+begin
+  select array_agg(gene_id) into gene_ids from app_public_v2.gene_map(genes) gm;
+  raise debug 'background_enrich %: gene_map %ms', background.id, round((extract(epoch from clock_timestamp() - start) * 1000)::numeric, 1);
+  if gene_ids is not null then
+    -- the full result of a query is cached, pages & repeats of it are served from the cache
+    cache_key := app_private_v2.enrich_cache_key(
+      background.id,
+      array[app_private_v2.enrich_cache_gene_ids(gene_ids)],
+      jsonb_build_array(
+        background_enrich.filter_term,
+        background_enrich.overlap_ge,
+        background_enrich.pvalue_le,
+        background_enrich.adj_pvalue_le,
+        background_enrich.filter_fda,
+        background_enrich.sortby,
+        background_enrich.filter_ko,
+        background_enrich.top_n
+      )
+    );
+    select (c.result).* into result
+    from app_private_v2.enrich_cache c
+    where c.key = cache_key;
+    if found then
+      raise debug 'background_enrich %: cache hit', background.id;
+      begin
+        perform app_private_v2.enrich_cache_touch('app_private_v2.enrich_cache', cache_key);
+      exception when others then
+        raise debug 'background_enrich %: cache not touched: %', background.id, sqlerrm;
+      end;
+    else
+      select r.* into result
+      from app_private_v2.indexed_enrich(
+        background_enrich.background,
+        gene_ids,
+        background_enrich.filter_term,
+        background_enrich.overlap_ge,
+        background_enrich.pvalue_le,
+        background_enrich.adj_pvalue_le,
+        null,
+        null,
+        background_enrich.filter_fda,
+        background_enrich.sortby,
+        background_enrich.filter_ko,
+        background_enrich.top_n
+      ) r;
+      begin
+        perform app_private_v2.enrich_cache_put(cache_key, background.id, result);
+      exception when others then
+        -- e.g. in a read only transaction, the result is still returned
+        raise debug 'background_enrich %: result not cached: %', background.id, sqlerrm;
+      end;
+    end if;
+    -- paged like the enrich service does, consensus results are paged alongside
+    result.nodes := result.nodes[page_start + 1 : coalesce(page_start + background_enrich."first", cardinality(result.nodes))];
+    result.consensus := result.consensus[page_start + 1 : coalesce(page_start + background_enrich."first", cardinality(result.consensus))];
+    result.moas := result.moas[page_start + 1 : coalesce(page_start + background_enrich."first", cardinality(result.moas))];
+    return result;
+  end if;
+  select r.* into result
+  from app_private_v2.indexed_enrich(
+    background_enrich.background,
+    gene_ids,
+    background_enrich.filter_term,
+    background_enrich.overlap_ge,
+    background_enrich.pvalue_le,
+    background_enrich.adj_pvalue_le,
+    background_enrich."offset",
+    background_enrich."first",
+    background_enrich.filter_fda,
+    background_enrich.sortby,
+    background_enrich.filter_ko,
+    background_enrich.top_n
+  ) r;
+  return result;
+end;
+$$ language plpgsql volatile parallel unsafe;
+
+create or replace function app_public_v2.background_enrich(
+  background app_public_v2.background,
+  genes varchar[],
+  filter_term varchar default null,
+  overlap_ge int default 1,
+  pvalue_le double precision default 0.05,
+  adj_pvalue_le double precision default 0.05,
+  "offset" int default null,
+  "first" int default null,
+  filter_fda boolean default false,
+  sortby varchar default null,
+  filter_ko boolean default false,
+  top_n int default 10000
+) returns app_public_v2.paginated_enrich_result
+as $$
+  select r.*
+  from app_private_v2.background_enrich(
+    background_enrich.background,
+    background_enrich.genes,
+    background_enrich.filter_term,
+    background_enrich.overlap_ge,
+    background_enrich.pvalue_le,
+    background_enrich.adj_pvalue_le,
+    background_enrich."offset",
+    background_enrich."first",
+    background_enrich.filter_fda,
+    background_enrich.sortby,
+    background_enrich.filter_ko,
+    background_enrich.top_n
+  ) r;
+$$ language sql stable parallel unsafe security definer;
+grant execute on function app_public_v2.background_enrich to guest, authenticated;
+
+
+create or replace function app_private_v2.background_paired_enrich(
+  background app_public_v2.background,
+  genes_up varchar[],
+  genes_down varchar[],
+  filter_term varchar default null,
+  overlap_ge int default 1,
+  pvalue_le double precision default 0.05,
+  adj_pvalue_le double precision default 0.05,
+  "offset" int default null,
+  "first" int default null,
+  filter_fda boolean default false,
+  sortby varchar default null,
+  filter_ko boolean default false,
+  top_n int default 10000
+) returns app_public_v2.paginated_paired_enrich_result
+as $$
+declare
+  start timestamptz := clock_timestamp();
+  gene_ids_up uuid[];
+  gene_ids_down uuid[];
+  cache_key uuid;
+  page_start int := coalesce(background_paired_enrich."offset", 0);
+  result app_public_v2.paginated_paired_enrich_result;
+begin
+  select array_agg(gene_id) into gene_ids_up from app_public_v2.gene_map(genes_up) gm;
+  select array_agg(gene_id) into gene_ids_down from app_public_v2.gene_map(genes_down) gm;
+  raise debug 'background_paired_enrich %: gene_map %ms', background.id, round((extract(epoch from clock_timestamp() - start) * 1000)::numeric, 1);
+  if gene_ids_up is not null and gene_ids_down is not null then
+    -- the full result of a query is cached, pages & repeats of it are served from the cache
+    cache_key := app_private_v2.enrich_cache_key(
+      background.id,
+      array[app_private_v2.enrich_cache_gene_ids(gene_ids_up), app_private_v2.enrich_cache_gene_ids(gene_ids_down)],
+      jsonb_build_array(
+        background_paired_enrich.filter_term,
+        background_paired_enrich.overlap_ge,
+        background_paired_enrich.pvalue_le,
+        background_paired_enrich.adj_pvalue_le,
+        background_paired_enrich.filter_fda,
+        background_paired_enrich.sortby,
+        background_paired_enrich.filter_ko,
+        background_paired_enrich.top_n
+      )
+    );
+    select (c.result).* into result
+    from app_private_v2.paired_enrich_cache c
+    where c.key = cache_key;
+    if found then
+      raise debug 'background_paired_enrich %: cache hit', background.id;
+      begin
+        perform app_private_v2.enrich_cache_touch('app_private_v2.paired_enrich_cache', cache_key);
+      exception when others then
+        raise debug 'background_paired_enrich %: cache not touched: %', background.id, sqlerrm;
+      end;
+    else
+      select r.* into result
+      from app_private_v2.indexed_paired_enrich(
+        background_paired_enrich.background,
+        gene_ids_up,
+        gene_ids_down,
+        background_paired_enrich.filter_term,
+        background_paired_enrich.overlap_ge,
+        background_paired_enrich.pvalue_le,
+        background_paired_enrich.adj_pvalue_le,
+        null,
+        null,
+        background_paired_enrich.filter_fda,
+        background_paired_enrich.sortby,
+        background_paired_enrich.filter_ko,
+        background_paired_enrich.top_n
+      ) r;
+      begin
+        perform app_private_v2.paired_enrich_cache_put(cache_key, background.id, result);
+      exception when others then
+        -- e.g. in a read only transaction, the result is still returned
+        raise debug 'background_paired_enrich %: result not cached: %', background.id, sqlerrm;
+      end;
+    end if;
+    -- paged like the enrich service does, consensus results are paged alongside
+    result.nodes := result.nodes[page_start + 1 : coalesce(page_start + background_paired_enrich."first", cardinality(result.nodes))];
+    result.consensus := result.consensus[page_start + 1 : coalesce(page_start + background_paired_enrich."first", cardinality(result.consensus))];
+    result.moas := result.moas[page_start + 1 : coalesce(page_start + background_paired_enrich."first", cardinality(result.moas))];
+    return result;
+  end if;
+  select r.* into result
+  from app_private_v2.indexed_paired_enrich(
+    background_paired_enrich.background,
+    gene_ids_up,
+    gene_ids_down,
+    background_paired_enrich.filter_term,
+    background_paired_enrich.overlap_ge,
+    background_paired_enrich.pvalue_le,
+    background_paired_enrich.adj_pvalue_le,
+    background_paired_enrich."offset",
+    background_paired_enrich."first",
+    background_paired_enrich.filter_fda,
+    background_paired_enrich.sortby,
+    background_paired_enrich.filter_ko,
+    background_paired_enrich.top_n
+  ) r;
+  return result;
+end;
+$$ language plpgsql volatile parallel unsafe;
+
+create or replace function app_public_v2.background_paired_enrich(
+  background app_public_v2.background,
+  genes_up varchar[],
+  genes_down varchar[],
+  filter_term varchar default null,
+  overlap_ge int default 1,
+  pvalue_le double precision default 0.05,
+  adj_pvalue_le double precision default 0.05,
+  "offset" int default null,
+  "first" int default null,
+  filter_fda boolean default false,
+  sortby varchar default null,
+  filter_ko boolean default false,
+  top_n int default 10000
+) returns app_public_v2.paginated_paired_enrich_result
+as $$
+  select r.*
+  from app_private_v2.background_paired_enrich(
+    background_paired_enrich.background,
+    background_paired_enrich.genes_up,
+    background_paired_enrich.genes_down,
+    background_paired_enrich.filter_term,
+    background_paired_enrich.overlap_ge,
+    background_paired_enrich.pvalue_le,
+    background_paired_enrich.adj_pvalue_le,
+    background_paired_enrich."offset",
+    background_paired_enrich."first",
+    background_paired_enrich.filter_fda,
+    background_paired_enrich.sortby,
+    background_paired_enrich.filter_ko,
+    background_paired_enrich.top_n
+  ) r;
+$$ language sql stable parallel unsafe security definer;
+grant execute on function app_public_v2.background_paired_enrich to guest, authenticated;
+
+-- migrate:down
+
+create or replace function app_public_v2.background_enrich(
+  background app_public_v2.background,
+  genes varchar[],
+  filter_term varchar default null,
+  overlap_ge int default 1,
+  pvalue_le double precision default 0.05,
+  adj_pvalue_le double precision default 0.05,
+  "offset" int default null,
+  "first" int default null,
+  filter_fda boolean default false,
+  sortby varchar default null,
+  filter_ko boolean default false,
+  top_n int default 10000
+) returns app_public_v2.paginated_enrich_result
+as $$
+declare
+  start timestamptz := clock_timestamp();
+  gene_ids uuid[];
+  result app_public_v2.paginated_enrich_result;
+begin
+  select array_agg(gene_id) into gene_ids from app_public_v2.gene_map(genes) gm;
+  raise debug 'background_enrich %: gene_map %ms', background.id, round((extract(epoch from clock_timestamp() - start) * 1000)::numeric, 1);
+  select r.* into result
+  from app_private_v2.indexed_enrich(
+    background_enrich.background,
+    gene_ids,
+    background_enrich.filter_term,
+    background_enrich.overlap_ge,
+    background_enrich.pvalue_le,
+    background_enrich.adj_pvalue_le,
+    background_enrich."offset",
+    background_enrich."first",
+    background_enrich.filter_fda,
+    background_enrich.sortby,
+    background_enrich.filter_ko,
+    background_enrich.top_n
+  ) r;
+  return result;
+end;
+$$ language plpgsql immutable parallel safe security definer;
+grant execute on function app_public_v2.background_enrich to guest, authenticated;
+
+
+create or replace function app_public_v2.background_paired_enrich(
+  background app_public_v2.background,
+  genes_up varchar[],
+  genes_down varchar[],
+  filter_term varchar default null,
+  overlap_ge int default 1,
+  pvalue_le double precision default 0.05,
+  adj_pvalue_le double precision default 0.05,
+  "offset" int default null,
+  "first" int default null,
+  filter_fda boolean default false,
+  sortby varchar default null,
+  filter_ko boolean default false,
+  top_n int default 10000
+) returns app_public_v2.paginated_paired_enrich_result
+as $$
+declare
+  start timestamptz := clock_timestamp();
+  gene_ids_up uuid[];
+  gene_ids_down uuid[];
+  result app_public_v2.paginated_paired_enrich_result;
+begin
+  select array_agg(gene_id) into gene_ids_up from app_public_v2.gene_map(genes_up) gm;
+  select array_agg(gene_id) into gene_ids_down from app_public_v2.gene_map(genes_down) gm;
+  raise debug 'background_paired_enrich %: gene_map %ms', background.id, round((extract(epoch from clock_timestamp() - start) * 1000)::numeric, 1);
+  select r.* into result
+  from app_private_v2.indexed_paired_enrich(
+    background_paired_enrich.background,
+    gene_ids_up,
+    gene_ids_down,
+    background_paired_enrich.filter_term,
+    background_paired_enrich.overlap_ge,
+    background_paired_enrich.pvalue_le,
+    background_paired_enrich.adj_pvalue_le,
+    background_paired_enrich."offset",
+    background_paired_enrich."first",
+    background_paired_enrich.filter_fda,
+    background_paired_enrich.sortby,
+    background_paired_enrich.filter_ko,
+    background_paired_enrich.top_n
+  ) r;
+  return result;
+end;
+$$ language plpgsql immutable parallel safe security definer;
+grant execute on function app_public_v2.background_paired_enrich to guest, authenticated;
+
+drop function app_private_v2.background_paired_enrich;
+drop function app_private_v2.background_enrich;
+drop trigger enrich_cache_invalidate on app_public_v2.background;
+drop function app_private_v2.enrich_cache_invalidate;
+drop function app_private_v2.enrich_cache_touch;
+drop function app_private_v2.paired_enrich_cache_put;
+drop table app_private_v2.paired_enrich_cache;
+drop function app_private_v2.enrich_cache_put;
+drop table app_private_v2.enrich_cache;
+drop function app_private_v2.enrich_cache_maintain_size;
+drop table app_private_v2.enrich_cache_size;
+drop function app_private_v2.enrich_cache_key;
+drop function app_private_v2.enrich_cache_gene_ids;
+drop function app_private_v2.enrich_cache_max_bytes;
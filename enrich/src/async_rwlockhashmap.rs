@@ -36,6 +36,16 @@ where K: Eq + PartialEq + Hash {
     Some(value)
   }
 
+  /**
+   * Like get_read but doesn't wait for a writer to finish, the inner option
+   * is None while the value is being written to.
+   */
+  pub async fn try_get_read<Q: ?Sized>(&self, k: &Q) -> Option<Option<RwLockReadGuardArc<V>>>
+  where K: Borrow<Q>, Q: Hash + Eq {
+    let reader = self.0.read().await;
+    Some(reader.get(&k)?.try_read_arc())
+  }
+
   pub async fn insert_write(&self, k: K, v: V) -> RwLockWriteGuardArc<V> {
     let mut writer = self.0.write().await;
     let v = Arc::new(RwLock::new(v));
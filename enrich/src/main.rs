@@ -259,7 +259,7 @@ async fn ensure_index(db: &mut Connection<Postgres>, state: &State<PersistentSta
 
     println!("[{}] initializing", background_id);
     let start = Instant::now();
-    {
+    let result = async {
         // this lets us write a new bitmap by only blocking the whole hashmap for a short period to register the new bitmap
         // after which we block the new empty bitmap for writing
         let mut bitmap = state.bitmaps.insert_write(background_id, Bitmap::new()).await;
@@ -309,8 +309,15 @@ async fn ensure_index(db: &mut Connection<Postgres>, state: &State<PersistentSta
             .await;
         // compute and store pairs
         bitmap.finalize();
+        Ok::<(), String>(())
+    }.await;
+    if let Err(e) = result {
+        // don't leave a partial index registered as if it were ready, the next request can try again
+        state.bitmaps.remove(&background_id).await;
+        println!("[{}] failed to initialize: {}", background_id, e);
+        return Err(e)
     }
-    
+
     let duration = start.elapsed();
     println!("[{}] initialized in {:?}", background_id, duration);
     {
@@ -335,6 +342,27 @@ async fn ensure(
     }))
 }
 
+/**
+ * Report whether the index of a background is ready without waiting for it, this lets
+ *  clients start building an index with the route above and poll this until it's warm.
+ */
+#[get("/<background_id>/status")]
+async fn status(
+    state: &State<PersistentState>,
+    background_id: &str,
+) -> Result<Value, Custom<Value>> {
+    let background_id = Uuid::parse_str(background_id).map_err(|e| Custom(Status::BadRequest, json!({ "error": e.to_string() })))?;
+    match state.bitmaps.try_get_read(&background_id).await {
+        None => Err(Custom(Status::NotFound, json!({ "status": "missing" }))),
+        Some(None) => Ok(json!({ "status": "building" })),
+        Some(Some(bitmap)) => Ok(json!({
+            "status": "ready",
+            "columns": bitmap.columns.len(),
+            "index": bitmap.values.len(),
+        })),
+    }
+}
+
 /**
  * This is a helper for building a GMT file on the fly, it's much cheaper to do this here
  *  than fetch it from the database, it's also nice since we won't need to save raw files.
@@ -1634,5 +1662,5 @@ fn rocket() -> _ {
             cachepair: Cache::new()
         })
         .attach(Postgres::init())
-        .mount("/", routes![ensure, get_gmt, query, query_pairs, delete])
+        .mount("/", routes![ensure, status, get_gmt, query, query_pairs, delete])
 }